@@ -0,0 +1,36 @@
+import random
+from math import exp, cos, sqrt
+from plotz import Plot
+
+# Damped oscillation, measured 20 times with some noise
+random.seed(42)
+t = [0.25*i for i in range(41)]
+runs = [[exp(-x/5)*cos(x) + random.gauss(0, 0.1) for x in t] for _ in range(20)]
+mean = [sum(run[i] for run in runs) / len(runs) for i in range(len(t))]
+std = [sqrt(sum((run[i]-mean[i])**2 for run in runs) / (len(runs)-1)) for i in range(len(t))]
+
+with Plot("plot") as p:
+    p.title = "Mean and spread of 20 noisy measurements"
+    p.x.label = "$t$"
+    p.y.label = "$u$"
+
+    # band
+    p.band(t,
+           [m - 2*s for (m, s) in zip(mean, std)],
+           [m + 2*s for (m, s) in zip(mean, std)],
+           title=r"mean $\pm 2\sigma$")
+    # band
+
+    p.plot(list(zip(t, mean)), title="mean")
+
+    # errorbar
+    p.errorbar(t[::4], runs[0][::4], 0.1, title="first run")
+    # errorbar
+
+    # errorbar: asymmetric
+    p.errorbar(t[2::8], [exp(-x/5) for x in t[2::8]],
+               lo=[0.05]*len(t[2::8]), hi=[0.15]*len(t[2::8]),
+               title="envelope")
+    # errorbar: asymmetric
+
+    p.legend("north east")
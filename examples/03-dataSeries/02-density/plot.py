@@ -0,0 +1,24 @@
+import random
+from plotz import Plot
+
+# Mixture of two gaussian clouds
+random.seed(42)
+points = ([(random.gauss(0, 1), random.gauss(0, 1)) for _ in range(60000)] +
+          [(random.gauss(2.5, 0.6), random.gauss(1.5, 0.4)) for _ in range(20000)])
+
+with Plot("plot") as p:
+    p.title = "Density of a cloud of 80000 points"
+    p.x.label = "$x$"
+    p.y.label = "$y$"
+
+    # density
+    d = p.density(points, bins=(60, 40), range=((-4, 5), (-3.5, 3.5)))
+    # density
+
+    # levels
+    d.levels = 12
+    # levels
+
+    # colormap
+    p.style.density = ["FFFFFF", "FFF7BC", "FEC44F", "EC7014", "993404"]
+    # colormap
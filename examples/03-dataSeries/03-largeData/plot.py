@@ -0,0 +1,44 @@
+import random
+from math import sin, pi
+from plotz import Plot
+
+random.seed(42)
+
+# Long time series: a slow signal with fast noise, sampled 200000 times
+n = 200000
+signal = [(i/n, sin(2*pi*i/n) + 0.3*sin(400*pi*i/n) + random.gauss(0, 0.1))
+          for i in range(n)]
+
+with Plot("plot") as p:
+    p.title = "Time series of %d samples" % n
+    p.x.label = "$t$"
+    p.y.label = "$u$"
+
+    # envelope
+    line = p.plot(signal, title="min/max envelope")
+    line.envelope = "fill"
+    # envelope
+
+    # envelope: line
+    line = p.plot([(t, sin(2*pi*t) - 1.5) for (t, _) in signal], title="downsampled line")
+    line.envelope = "line"
+    # envelope: line
+
+    # draft points
+    p.draft_points = 100
+    # draft points
+
+
+# Dense scatter plot
+with Plot("scatter") as p:
+    p.title = "Scatter plot of 100000 points"
+
+    # raster
+    line = p.plot([(random.gauss(0, 1), random.gauss(0, 1)) for _ in range(100000)])
+    line.style({"line": False, "markers": True})
+    line.raster = True
+    # raster
+
+    # raster dpi
+    line.raster_dpi = 150
+    # raster dpi
@@ -1,8 +1,35 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
+""" Build the examples gallery
+
+Usage: python3 doc.py [-j JOBS] [-f]
+
+Example scripts are run concurrently, and only outdated outputs are rebuilt:
+scripts whose dependencies (plot.py, data files, plotz.sty...) did not change
+since their last run are skipped, as well as LaTeX documents and svg files which
+are newer than their sources.
+"""
 
 import re
-import sys, os, os.path
+import sys
+import os
+import os.path
+import time
+import argparse
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+EXAMPLES = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(EXAMPLES)
+
+sys.path.insert(0, ROOT)
+import plotz.build
+from plotz.backend import convert_svg
+
+# Examples and documents use the version of PlotZ in this repository
+ENV = dict(os.environ)
+ENV["PYTHONPATH"] = ROOT + os.pathsep + ENV.get("PYTHONPATH", "")
+ENV["TEXINPUTS"] = ROOT + os.pathsep + ENV.get("TEXINPUTS", "")
 
 
 class WorkingDirectory(object):
@@ -40,7 +67,7 @@ def include(filename, delimiter=None, indent=""):
 
         ret += suffix
         return ret
-    except:
+    except (IOError, OSError):
         return "\n"
 
 def head(filename, lines=10):
@@ -53,10 +80,18 @@ def head(filename, lines=10):
 
             if i == lines:
                 return ret + "...\n```\n"
+    return ret + "```\n"
+
+def outdated(target, sources):
+    """Check whether a target file is older than any of its sources"""
+    if not os.path.exists(target):
+        return True
+    mtime = os.path.getmtime(target)
+    return any(os.path.getmtime(s) > mtime for s in sources if os.path.exists(s))
 
 def process_README(toc=None):
     plotz = re.compile("<!---plotz(.*)-->")
-    img = re.compile('<img src="(.*\.svg)\?raw=true&sanitize=true"/>')
+    img = re.compile(r'<img src="(.*\.svg)\?raw=true&sanitize=true"/>')
 
     filename = "README.md"
 
@@ -67,62 +102,39 @@ def process_README(toc=None):
         markdown = f.readlines()
 
     within_section = False
-    with open(filename, "w") as f:
-        for line in markdown:
-            if title is None and line.startswith("# "):
-                title = line[2:].strip()
+    contents = []
+    for line in markdown:
+        if title is None and line.startswith("# "):
+            title = line[2:].strip()
 
-            if image is None:
-                m = img.search(line)
-                if m:
-                    image = m.group(1).strip()
-
-            if not within_section:
-                f.write(line)
-
-            m = plotz.match(line.strip())
+        if image is None:
+            m = img.search(line)
             if m:
-                command = m.group(1).strip()
-                if command == "end":
-                    within_section = False
-                    f.write(line)
-                    continue
-
-                within_section = True
-                f.write(eval(command))
-
-    subprocess.call(["pandoc", "-f", "markdown_github", "README.md",
-                     "-t", "html", "-o", "README.html"])
-    return (title, image)
-
-
-def pdflatex(filename):
-    p = subprocess.Popen(["pdflatex", "-interaction=errorstopmode", filename], stdin=subprocess.PIPE)
-    p.stdin.close()
-    p.wait()
+                image = m.group(1).strip()
 
-def make():
-    print "  - generating plot"
-    print "    - python2 (+coverage)"
-    subprocess.call(["python-coverage", "run", "plot.py"])
-    print "    - python3"
-    subprocess.call(["python3", "plot.py"])
+        if not within_section:
+            contents.append(line)
 
-    if os.path.exists("document.tex"):
-        print "  - compiling LaTeX document"
-        pdflatex("document.tex")
+        m = plotz.match(line.strip())
+        if m:
+            command = m.group(1).strip()
+            if command == "end":
+                within_section = False
+                contents.append(line)
+                continue
 
-    if os.path.exists("presentation.tex"):
-        print "  - compiling LaTeX presentation"
-        pdflatex("presentation.tex")
+            within_section = True
+            contents.append(eval(command))
 
-    for filename in os.listdir("."):
-        if filename.endswith(".pdf"):
-            print "  - converting %s to svg" % filename
-            subprocess.call(["pdf2svg", filename, filename.replace(".pdf", ".svg")])
+    # Only touch files whose contents changed
+    if "".join(contents) != "".join(markdown):
+        with open(filename, "w") as f:
+            f.write("".join(contents))
 
-    print "  - processing README.md"
-    return process_README()
+    if shutil.which("pandoc") is not None and outdated("README.html", ["README.md"]):
+        subprocess.call(["pandoc", "-f", "markdown_github", "README.md",
+                         "-t", "html", "-o", "README.html"])
+    return (title, image)
 
 def table_of_contents(toc, level="##", path=""):
     ret = []
@@ -133,41 +145,109 @@ def table_of_contents(toc, level="##", path=""):
         if isinstance(entry[2], list):
             ret.append(table_of_contents(entry[2], level+"#", rel_path))
         else:
-            ret.append('[<img src="%s?raw=true&sanitize=true"/>](%s)\n' % (os.path.join(rel_path, entry[2]), rel_path))
+            ret.append('[<img src="%s?raw=true&sanitize=true"/>](%s)\n'
+                       % (os.path.join(rel_path, entry[2]), rel_path))
 
     return "\n".join(ret)
 
-
-def walk(rel_path = "", total_path = ""):
-    if total_path != "": print "\nEntering directory '%s'" % total_path
+def walk(rel_path=""):
     if os.path.exists("plot.py"):
-        ret = (rel_path,) + make()
+        return (rel_path,) + process_README()
+
+    toc = []
+    for entry in sorted(os.listdir(os.getcwd())):
+        if not os.path.isdir(entry) or entry.startswith("."):
+            continue
+
+        with WorkingDirectory(entry):
+            toc.append(walk(entry))
+
+    (title, _) = process_README(toc=toc)
+    return (rel_path, title, toc)
+
+
+def pdflatex(filename, sources, force=False):
+    """Compile a LaTeX document and convert it to svg, if it is outdated
+
+    Returns:
+      a status string: "skipped", "ok" or "failed"
+    """
+    (directory, name) = os.path.split(filename)
+    basename = os.path.splitext(filename)[0]
+
+    if not force and not outdated(basename + ".svg", [filename] + sources):
+        return "skipped"
+
+    with open(os.devnull, "w") as devnull:
+        p = subprocess.Popen(["pdflatex", "-interaction=batchmode", name],
+                             cwd=directory, env=ENV, stdin=subprocess.DEVNULL,
+                             stdout=devnull, stderr=devnull)
+        p.wait()
+
+    if p.returncode != 0 or not convert_svg(basename + ".pdf", basename + ".svg"):
+        return "failed"
+    return "ok"
+
+def documents(scripts):
+    """LaTeX documents of the examples, along with their sources"""
+    sty = os.path.join(ROOT, "plotz.sty")
+    docs = []
+    for script in scripts:
+        directory = os.path.dirname(os.path.abspath(script))
+        figures = [os.path.join(directory, f) for f in os.listdir(directory)
+                   if f.endswith(".tex")]
+        for name in ("document.tex", "presentation.tex"):
+            filename = os.path.join(directory, name)
+            if os.path.exists(filename):
+                docs.append((filename, figures + [sty]))
+    return docs
+
+def gallery():
+    """The gallery document, along with its sources (included figures)"""
+    filename = os.path.join(EXAMPLES, "gallery.tex")
+    with open(filename, "r") as f:
+        figures = re.findall(r"\\includegraphics(?:\[.*?\])?\{(.*?)\}", f.read())
+    return (filename, [os.path.join(EXAMPLES, fig + ".pdf") for fig in figures])
 
-    else:
-        toc = []
-        for entry in sorted(os.listdir(os.getcwd())):
-            if not os.path.isdir(entry):
-                continue
 
-            with WorkingDirectory(entry):
-                toc.append(walk(entry, os.path.join(total_path, entry)))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the PlotZ examples gallery")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of concurrent jobs (default: number of CPUs)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="rebuild everything, even up-to-date outputs")
+    args = parser.parse_args(argv)
+
+    start = time.time()
+
+    print("Running example scripts")
+    scripts = plotz.build.discover([EXAMPLES])
+    env = {"PYTHONPATH": ENV["PYTHONPATH"], "TEXINPUTS": ENV["TEXINPUTS"], "PLOTZ_SVG": "1",
+           "PLOTZ_INCREMENTAL": "0" if args.force else "1"}
+    jobs = plotz.build.build(scripts, jobs=args.jobs, force=args.force, env=env)
+
+    print("\nCompiling LaTeX documents")
+    def _compile(doc):
+        status = pdflatex(doc[0], doc[1], args.force)
+        print("  %-8s %s" % (status, os.path.relpath(doc[0], EXAMPLES)))
+        return status
 
-        (title, _) = process_README(toc=toc)
-        ret = (rel_path, title, toc)
+    # Documents include figures, which are all produced at this point
+    docs = documents(scripts)
+    with ThreadPoolExecutor(max_workers=args.jobs or os.cpu_count() or 1) as pool:
+        status = list(pool.map(_compile, docs))
 
-    if total_path != "": print "Leaving directory '%s'" % total_path
-    return ret
+    print("\nProcessing README files")
+    with WorkingDirectory(EXAMPLES):
+        walk()
 
+    print("\nCompiling gallery")
+    status.append(_compile(gallery()))
 
-subprocess.call(["find", ".", "-name", ".coverage", "-delete"])
-subprocess.call(["find", ".", "-name", "htmlcov", "-exec", "rm", "-rf", "{}", ";"])
-walk()
+    plotz.build.summary(jobs, time.time() - start)
 
-pdflatex("gallery")
-subprocess.call(["pdf2svg", "gallery.pdf", "gallery.svg"])
+    failed = status.count("failed") + sum(job.status not in ("ok", "skipped") for job in jobs)
+    return 0 if failed == 0 else 1
 
-find = subprocess.Popen(["find", ".", "-name", ".coverage"],
-                        stdout=subprocess.PIPE)
-coverage_files = [name.strip() for name in find.stdout.readlines()]
-subprocess.call(["python-coverage", "combine"] + coverage_files)
-subprocess.call(["python-coverage", "html", "-d", "../htmlcov"])
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,14 +26,18 @@ in a LaTeX document.
 """
 #pylint: disable=invalid-name
 
+import os
 import sys
 import math
-import re
 import numbers
+import array
 import plotz.utils
-from plotz.backend import StrictPrototype, TikzGenerator
+from plotz.backend import StrictPrototype, SlottedPrototype, TikzGenerator, GridGenerator
+from plotz.backend import Manifest, Stats, TmpDir
+from plotz.backend import render, render_async
 
-__all__ = ["Plot", "Axis", "Legend", "Style", "Line", "Function", "DataFile", "Steps"]
+__all__ = ["Plot", "AsyncPlot", "Grid", "Axis", "Legend", "Style", "Line", "Function", "DataFile",
+           "Steps", "Variant", "Density", "Band", "ErrorBars"]
 
 class Function(object):
     """Data generator for python functions
@@ -78,14 +82,22 @@ class Function(object):
         self._i += 1
         return (x, self._fun(x))
 
-def DataFile(filename, sep=re.compile(r"\s+"), comment="#"):
+# Default DataFile separator, compiled on first use (see DataFile)
+_WHITESPACE = object()
+
+def DataFile(filename, sep=_WHITESPACE, comment="#"):
     """ Data generator for an ASCII datafile
 
     Args:
       filename (str):  path to the data file
-      sep (str or re): delimiter for columns
+      sep (str or re): delimiter for columns (by default, any run of whitespace)
       comment (str):   string indicating the beginning of a comment line
     """
+    if sep is _WHITESPACE:
+        import re #pylint: disable=import-outside-toplevel
+        sep = re.compile(r"\s+")
+
+    Manifest.track(filename)
     with open(filename, "r") as f:
         for line in f:
             if comment is not None and line.startswith(comment):
@@ -138,16 +150,18 @@ def Steps(generator):
         y = yNew
 
 
-class Axis(StrictPrototype):
+class Axis(SlottedPrototype):
     """Plot axis
 
     This object stores everything related to plot axes: range, position,
     position of ticks...
     """
     #pylint: disable=too-many-instance-attributes
+    __slots__ = ("_orientation", "_setup", "_scale", "label", "label_rotate", "label_shift",
+                 "max", "min", "pos", "ticks", "tick_format", "tick_rotate", "tick_anchor")
 
     def __init__(self, orientation):
-        StrictPrototype.__init__(self)
+        SlottedPrototype.__init__(self)
 
         # Internal members
         self._orientation = orientation
@@ -286,9 +300,9 @@ Pretty print regular values and use 10^x in the case of logarithmic scale."""
 
     def _update_tick_rotation(self):
         anchor = ["north", "north east",
-                  "east", "south east",
-                  "south", "south west",
-                  "west", "north west"]
+                 "east", "south east",
+                 "south", "south west",
+                 "west", "north west"]
 
         if self.tick_anchor is None:
             rot = (self.tick_rotate + (self._orientation - 1) * 90.) / 45.
@@ -306,13 +320,14 @@ Pretty print regular values and use 10^x in the case of logarithmic scale."""
         self.tick_anchor = anchor[int(round(rot) % 8)]
 
 
-class Style(StrictPrototype):
+class Style(SlottedPrototype):
     """This object is responsible for storing all settings related to the styling
     of the plot: colors, line patterns, markers..."""
     #pylint: disable=too-few-public-methods
+    __slots__ = ("color", "thickness", "pattern", "marker", "density")
 
     def __init__(self):
-        StrictPrototype.__init__(self)
+        SlottedPrototype.__init__(self)
 
         #: List of colors used in the plot. This might be more easily set using
         #: :py:func:`colormap`
@@ -342,6 +357,12 @@ class Style(StrictPrototype):
             r"$\blacktriangle$",
         ]
 
+        #: List of colors used for density plots, from lowest to highest density
+        #:
+        #: By default, a sequential blue colormap is used (colorbrewer2.org,
+        #: sequential, blues).
+        self.density = ["EFF3FF", "BDD7E7", "6BAED6", "3182BD", "08519C"]
+
         self._end_init()
 
     def colormap(self, name=None):
@@ -408,16 +429,18 @@ class Style(StrictPrototype):
                 + r"2pt on \pgflinewidth off 2pt on \pgflinewidth off 2pt"
             ]
 
-class Line(StrictPrototype):
+class Line(SlottedPrototype):
     """ A line in the plot.
 
     Plotted lines are created by :py:meth:`Plot.plot`, but they can be altered
     afterwards.
     """
     #pylint: disable=too-few-public-methods, too-many-instance-attributes
+    __slots__ = ("_plot", "title", "line", "color", "markers", "markers_filter", "pattern",
+                 "thickness", "raster", "raster_dpi", "envelope", "points", "_markers_mask")
 
     def __init__(self, plot):
-        StrictPrototype.__init__(self)
+        SlottedPrototype.__init__(self)
         self._plot = plot
 
         #: Title of the line.
@@ -437,6 +460,10 @@ class Line(StrictPrototype):
         #: Filter determining when markers actually get drawn.
         #:
         #: See :py:class:`plotz.utils.Markers` for a list of built-in filters.
+        #: Custom filters can either derive from
+        #: :py:class:`plotz.utils.MarkersFilter`, or be co-routines (see
+        #: :py:func:`plotz.backend.consumer`) receiving data points and
+        #: returning False for points which should not get a marker.
         self.markers_filter = plotz.utils.Markers.always()
 
         #: Index of the line dash/dot pattern in the :py:attr:`Style.pattern`
@@ -446,8 +473,41 @@ class Line(StrictPrototype):
         #: Index of the line thickness in the :py:attr:`Style.thickness` list.
         self.thickness = None
 
+        #: True if the line should be rasterized
+        #:
+        #: Rasterized lines are rendered in python to a PNG image covering the
+        #: plotting area, which is embedded in the figure. This is useful for
+        #: very dense data sets (such as scatter clouds with millions of points),
+        #: for which vector output would be too heavy. Axes, ticks and legend
+        #: remain vector graphics. Images are written next to the figure, in
+        #: ``<output>-rasterX.png``.
+        self.raster = False
+
+        #: Resolution of the rasterized line (in dots per inch)
+        self.raster_dpi = 300
+
+        #: Downsampled rendering of the line, for long time series
+        #:
+        #: - None: all data points are drawn,
+        #: - "line": for each column of 1pt of the plotting area, only the
+        #:   first and last points, as well as the points of minimal and
+        #:   maximal ordinates are drawn (M4 algorithm). This does not change
+        #:   the visual result, but draws at most about 4 x
+        #:   :py:attr:`Plot.size_x` points.
+        #: - "fill": the area between the minimal and maximal ordinates of each
+        #:   column is filled, with at most about 4 x :py:attr:`Plot.size_x`
+        #:   points.
+        #:
+        #: Data points are expected to be sorted by increasing abscissa.
+        #: Markers are not drawn on downsampled lines.
+        self.envelope = None
+
         self.points = [[]]
 
+        # Result of the markers filter for each point, computed once before
+        # the plot gets rendered
+        self._markers_mask = None
+
         self._end_init()
 
     def style(self, properties):
@@ -466,6 +526,22 @@ class Line(StrictPrototype):
         for var in properties:
             self.__setattr__(var, properties[var])
 
+    def _scaled_mask(self, scale_x, scale_y):
+        """Run an array-based markers filter on a copy of itself
+
+        Args:
+          float scale_x: horizontal scale of the rendered plot (pt per unit)
+          float scale_y: vertical scale of the rendered plot (pt per unit)
+
+        Returns:
+          the markers mask of each subline
+        """
+        import copy #pylint: disable=import-outside-toplevel
+        markers_filter = copy.deepcopy(self.markers_filter)
+        if hasattr(markers_filter, "setup"):
+            markers_filter.setup(scale_x, scale_y)
+        return [markers_filter.mask(subline) for subline in self.points]
+
 class LineProperties(object):
     """ Manages the cycling through line properties """
     #pylint: disable=too-few-public-methods
@@ -476,17 +552,117 @@ class LineProperties(object):
         self.pattern = iter(range(100))
         self.thickness = iter(range(100))
 
-class Bar(StrictPrototype):
+class Bar(SlottedPrototype):
     """ Models a bar in an histogram """
     #pylint: disable=too-few-public-methods
+    __slots__ = ("title", "color", "points")
 
     def __init__(self):
-        StrictPrototype.__init__(self)
+        SlottedPrototype.__init__(self)
         self.title = None
         self.color = None
         self.points = []
         self._end_init()
 
+class Band(SlottedPrototype):
+    """ Band between lower and upper bounds (such as a confidence interval)
+
+    Bands are created by :py:meth:`Plot.band`, but they can be altered
+    afterwards.
+    """
+    #pylint: disable=too-few-public-methods
+    __slots__ = ("title", "color", "opacity", "points")
+
+    def __init__(self):
+        SlottedPrototype.__init__(self)
+
+        #: Title of the band.
+        #:
+        #: If set, this is what goes in the plot legend.
+        self.title = None
+
+        #: Index of the band color in the :py:attr:`Style.color` list.
+        self.color = None
+
+        #: Opacity of the band
+        self.opacity = 0.3
+
+        #: List of (*x*, *lower bound*, *upper bound*) points
+        self.points = []
+
+        self._end_init()
+
+class ErrorBars(SlottedPrototype):
+    """ Error bars around data points
+
+    Error bars are created by :py:meth:`Plot.errorbar`, but they can be altered
+    afterwards.
+    """
+    #pylint: disable=too-few-public-methods
+    __slots__ = ("title", "color", "markers", "cap", "points")
+
+    def __init__(self):
+        SlottedPrototype.__init__(self)
+
+        #: Title of the error bars.
+        #:
+        #: If set, this is what goes in the plot legend.
+        self.title = None
+
+        #: Index of the error bars color in the :py:attr:`Style.color` list.
+        self.color = None
+
+        #: Index of the marker drawn at data points in the
+        #: :py:attr:`Style.marker` list (or None).
+        self.markers = None
+
+        #: Half-width of the caps at the ends of error bars (in em)
+        self.cap = 0.3
+
+        #: List of (*x*, *y*, *lower bound*, *upper bound*) points
+        self.points = []
+
+        self._end_init()
+
+class Density(StrictPrototype):
+    """ Density of a 2D point cloud
+
+    Density plots are created by :py:meth:`Plot.density`, but they can be
+    altered afterwards.
+    """
+    #pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        StrictPrototype.__init__(self)
+
+        #: Title of the density plot.
+        #:
+        #: If set, this is what goes in the plot legend.
+        self.title = None
+
+        #: Number of bins along each axis (*nx*, *ny*)
+        self.bins = None
+
+        #: Range covered by the bins: ((*xmin*, *xmax*), (*ymin*, *ymax*))
+        self.range = None
+
+        #: Number of color levels
+        #:
+        #: Cell densities are mapped to this many colors of the
+        #: :py:attr:`Style.density` colormap. Adjacent cells having the same
+        #: color are drawn together.
+        self.levels = 8
+
+        #: True if the density should be embedded as an image rather than drawn
+        #: as a set of rectangles.
+        self.raster = False
+
+        #: Number of points in each cell, row by row (the first *nx* values
+        #: correspond to the first row of cells, at the bottom of the plot).
+        self.counts = []
+
+        self._end_init()
+
 class Legend(StrictPrototype):
     """ Plot legend """
     #pylint: disable=too-few-public-methods
@@ -546,7 +722,37 @@ class Histogram(StrictPrototype):
         self.gap = 0
         self._end_init()
 
-class Plot(StrictPrototype):
+class Variant(StrictPrototype):
+    """Alternate rendering of a plot
+
+    Variants are created by :py:meth:`Plot.variant`. They share all data and
+    settings with the plot they derive from, except for the attributes below,
+    which override the corresponding :py:class:`Plot` attributes when they are
+    set.
+    """
+    #pylint: disable=too-few-public-methods
+
+    def __init__(self, output):
+        StrictPrototype.__init__(self)
+
+        #: Basename of the output figure (see :py:attr:`Plot.output`)
+        self.output = output
+
+        #: Variant :py:class:`Style` (see :py:attr:`Plot.style`)
+        self.style = None
+
+        #: Variant scale (see :py:attr:`Plot.scale`)
+        self.scale = None
+
+        #: Variant width (see :py:attr:`Plot.size_x`)
+        self.size_x = None
+
+        #: Variant height (see :py:attr:`Plot.size_y`)
+        self.size_y = None
+
+        self._end_init()
+
+class Plot(SlottedPrototype):
     """ Master object to create a PlotZ figure.
 
     This object is supposed to be used in a ``with`` statement::
@@ -557,16 +763,23 @@ class Plot(StrictPrototype):
             # the plot is actually generated at the end of the block
     """
     #pylint: disable=too-many-instance-attributes,too-few-public-methods
+    __slots__ = ("output", "x", "y", "title", "size_x", "size_y", "scale", "draft_points",
+                 "style", "legend", "grid_x", "grid_y", "data_series", "variants", "histogram",
+                 "line", "line_type", "bar_type", "density_type", "band_type", "errorbar_type",
+                 "tikz", "depends", "_inputs",
+                 "incremental", "_preview", "svg", "engine", "engine_threshold", "engine_options",
+                 "stats", "stats_file")
 
     def __init__(self, output):
-        StrictPrototype.__init__(self)
+        SlottedPrototype.__init__(self)
 
         #: Basename of the output figure
         #:
         #: Plotz will generate two files
         #:   - ``<output>.tex``: the actual PlotZ figure, which you can include in
         #:     any LaTeX document using the ``plotz`` command.
-        #:   - ``<output>.pdf``: a rendered pdf version of the figure.
+        #:   - ``<output>.pdf``: a rendered pdf version of the figure (see
+        #:     :py:attr:`preview`).
         self.output = output
 
         #: x :py:class:`Axis`
@@ -600,6 +813,14 @@ class Plot(StrictPrototype):
         #: default plot size.
         self.scale = 1.0
 
+        #: Maximal number of points per line in the draft version of the plot
+        #:
+        #: Along with the full-resolution lines, a decimated version of them is
+        #: emitted. It is used by ``\plotz`` to compute the plot size, and
+        #: replaces the full lines in draft documents (see the ``draft`` option
+        #: of the ``plotz`` LaTeX package).
+        self.draft_points = 200
+
         #: Plot :py:class:`Style`
         self.style = Style()
 
@@ -613,20 +834,157 @@ class Plot(StrictPrototype):
         self.grid_y = False
 
         self.data_series = []
+        self.variants = []
         self.histogram = Histogram()
         self.line = LineProperties()
         self.line_type = Line
         self.bar_type = Bar
+        self.density_type = Density
+        self.band_type = Band
+        self.errorbar_type = ErrorBars
 
         self.tikz = ""
 
+        #: Additional files on which the plot depends
+        #:
+        #: Data files read using :py:func:`DataFile` within the ``with`` block
+        #: of the plot are automatically tracked, along with the plot script
+        #: itself. Other dependencies (for example data read by other means, or
+        #: before entering the ``with`` block) should be listed here.
+        self.depends = []
+
+        # Data files tracked while the plot is open
+        self._inputs = []
+
+        #: True if the plot should only be regenerated when its dependencies
+        #: change
+        #:
+        #: Dependencies of each output are recorded in ``<output>.deps.json``.
+        #: When this is True, and none of the dependencies of the plot (and its
+        #: variants) changed since they were last generated, the plot is not
+        #: regenerated. This can also be activated by setting the
+        #: ``PLOTZ_INCREMENTAL`` environment variable to 1.
+        self.incremental = os.environ.get("PLOTZ_INCREMENTAL", "0") not in ("", "0")
+
+        # Production of the pdf preview (see :py:attr:`preview`)
+        (preview, svg) = Manifest.requested(os.environ)
+        self.preview = True if preview is None else preview
+
+        #: Production of an svg version of the preview
+        #:
+        #: - False: no svg file is produced,
+        #: - True: ``<output>.svg`` is converted from the pdf preview, using
+        #:   ``pdf2svg`` (or ``dvisvgm`` if it is not available),
+        #: - "dvi": the figure is compiled to DVI and directly converted to
+        #:   ``<output>.svg`` by ``dvisvgm``, which is faster.
+        #:
+        #: The svg file is produced along with the pdf preview, which means
+        #: that it can also be deferred (see :py:attr:`preview`). The default
+        #: value can be set using the ``PLOTZ_SVG`` environment variable (set to
+        #: "1" or "dvi").
+        self.svg = svg or False
+
+        #: TeX engine used to compile the pdf preview
+        #:
+        #: Supported engines are "pdflatex", "lualatex" and "xelatex". In "auto"
+        #: mode, lualatex (which allocates memory dynamically) is used for plots
+        #: whose lines are drawn with more than :py:attr:`engine_threshold`
+        #: points (rasterized lines and densities do not count), and pdflatex
+        #: otherwise. The default engine can be set using the ``PLOTZ_ENGINE``
+        #: environment variable.
+        #:
+        #: Note that the ``.tex`` figure should be included in a document compiled
+        #: with an engine able to handle it.
+        self.engine = os.environ.get("PLOTZ_ENGINE", "pdflatex")
+
+        #: Number of data points above which lualatex is used in "auto"
+        #: :py:attr:`engine` mode
+        self.engine_threshold = 100000
+
+        #: Additional command-line options for each TeX engine
+        #:
+        #: Example: ``{"lualatex": ["-shell-escape"]}``
+        self.engine_options = {}
+
+        #: Rendering statistics (see :py:class:`plotz.backend.Stats`)
+        self.stats = Stats()
+
+        #: True if rendering statistics should be written to
+        #: ``<output>.stats.json``
+        #:
+        #: This can also be activated by setting the ``PLOTZ_STATS`` environment
+        #: variable to 1.
+        self.stats_file = os.environ.get("PLOTZ_STATS", "0") not in ("", "0")
+
         self._end_init()
 
+    @property
+    def preview(self):
+        """Production of the pdf preview
+
+        - True: ``<output>.pdf`` is produced along with ``<output>.tex``,
+        - False: only ``<output>.tex`` is produced,
+        - "defer": only ``<output>.tex`` is produced, and the preview is
+          recorded as pending, to be produced later in a batch (see
+          ``python -m plotz preview``).
+
+        The default value can be set using the ``PLOTZ_PREVIEW`` environment
+        variable (set to "0", "1" or "defer").
+        """
+        return self._preview
+
+    @preview.setter
+    def preview(self, mode):
+        if mode == "defer":
+            self._preview = "defer"
+        elif mode in (True, False):
+            self._preview = bool(mode)
+        else:
+            raise ValueError("Plotz error: invalid preview mode %r (expected True, False "
+                             "or \"defer\")" % (mode,))
+
     def grid(self):
         """ Draw a grid at axes ticks """
         self.grid_x = True
         self.grid_y = True
 
+    def variant(self, output, style=None, scale=None, size_x=None, size_y=None):
+        """ Declare an alternate rendering of the plot
+
+        Data are read and processed only once, after which the plot itself and
+        all its variants are rendered. For example, the following produces
+        ``myname.tex``, as well as a monochrome version of it in
+        ``myname-mono.tex``::
+
+            with Plot("myname") as p:
+                mono = Style()
+                mono.colormap("monochrome")
+                mono.dashed()
+                p.variant("myname-mono", style=mono)
+
+                p.plot(...)
+
+        Args:
+          str output: basename of the output figure
+          style: :py:class:`Style` of the variant
+          float scale: scale of the variant
+          float size_x: width of the variant
+          float size_y: height of the variant
+
+        Returns:
+          the :py:class:`Variant`, which can be modified afterwards as needed.
+        """
+        #pylint: disable=too-many-arguments
+
+        var = Variant(output)
+        var.style = style
+        var.scale = scale
+        var.size_x = size_x
+        var.size_y = size_y
+
+        self.variants.append(var)
+        return var
+
     def plot(self, data, col=(0, 1), title=None):
         """ Plot a curve
 
@@ -640,39 +998,50 @@ class Plot(StrictPrototype):
         """
         #pylint: disable=protected-access
 
-        self.x._setup = False
-        self.y._setup = False
-
-        if isinstance(data, Function) and data.range is None:
-            self._update_histogram()
-            data.range = (self.x.min, self.x.max)
+        with self.stats.timer("ingest"):
+            self.x._setup = False
+            self.y._setup = False
+
+            if isinstance(data, Function) and data.range is None:
+                self._update_histogram()
+                data.range = (self.x.min, self.x.max)
+
+            l = Line(self)
+            l.title = title
+            l.color = next(self.line.color)
+            l.pattern = next(self.line.pattern)
+            l.thickness = next(self.line.thickness)
+
+            # Axes ranges are updated once, after all data have been read
+            (scale_x, scale_y) = (self.x.scale, self.y.scale)
+            (xmin, xmax) = (self.x.min, self.x.max)
+            (ymin, ymax) = (self.y.min, self.y.max)
+            for row in data:
+                try:
+                    x = scale_x(row[col[0]])
+                    y = scale_y(row[col[1]])
 
-        l = Line(self)
-        l.title = title
-        l.color = next(self.line.color)
-        l.pattern = next(self.line.pattern)
-        l.thickness = next(self.line.thickness)
+                    l.points[-1].append((x, y))
 
-        for row in data:
-            try:
-                x = self.x.scale(row[col[0]])
-                y = self.y.scale(row[col[1]])
+                    xmin = min(x, xmin)
+                    xmax = max(x, xmax)
 
-                l.points[-1].append((x, y))
+                    ymin = min(y, ymin)
+                    ymax = max(y, ymax)
+                except (TypeError, IndexError):
+                    if l.points[-1] != []:
+                        l.points.append([])
 
-                self.x.min = min(x, self.x.min)
-                self.x.max = max(x, self.x.max)
+            (self.x.min, self.x.max) = (xmin, xmax)
+            (self.y.min, self.y.max) = (ymin, ymax)
 
-                self.y.min = min(y, self.y.min)
-                self.y.max = max(y, self.y.max)
-            except (TypeError, IndexError):
-                if l.points[-1] != []:
-                    l.points.append([])
+            if l.points[-1] == []:
+                del l.points[-1]
 
-        if l.points[-1] == []:
-            del l.points[-1]
+            self.data_series.append(l)
 
-        self.data_series.append(l)
+            self.stats.series += 1
+            self.stats.points += sum(len(subline) for subline in l.points)
         return l
 
     def hist(self, data, col=0, title=None):
@@ -688,28 +1057,226 @@ class Plot(StrictPrototype):
         """
         #pylint: disable=blacklisted-name
 
-        bar = Bar()
-        bar.title = title
-        bar.color = next(self.line.color)
+        with self.stats.timer("ingest"):
+            bar = Bar()
+            bar.title = title
+            bar.color = next(self.line.color)
 
-        for y in data:
-            try:
-                y = float(y)
-            except (TypeError, ValueError):
-                y = y[col]
+            (ymin, ymax) = (self.y.min, self.y.max)
+            for y in data:
+                try:
+                    y = float(y)
+                except (TypeError, ValueError):
+                    y = y[col]
 
-            try:
-                y = float(y)
-            except (TypeError, ValueError):
-                y = 0.
+                try:
+                    y = float(y)
+                except (TypeError, ValueError):
+                    y = 0.
+
+                bar.points.append(y)
+                ymin = min(y, ymin)
+                ymax = max(y, ymax)
 
-            bar.points.append(y)
-            self.y.min = min(y, self.y.min)
-            self.y.max = max(y, self.y.max)
+            (self.y.min, self.y.max) = (ymin, ymax)
 
-        self.data_series.append(bar)
+            self.data_series.append(bar)
+
+            self.stats.series += 1
+            self.stats.points += len(bar.points)
         return bar
 
+    def density(self, data, bins=(50, 50), col=(0, 1), range=None, title=None):
+        """ Plot the density of a 2D point cloud
+
+        Points are counted in a grid of cells, and each cell is colored
+        according to the number of points it contains. The cost of rendering
+        the plot only depends on the number of cells, not on the number of
+        points.
+
+        Args:
+          data: data generator (see :py:class:`Function` and :py:class:`DataFile`)
+          tuple bins: number of cells (*nx*, *ny*) along both axes
+          tuple col:  tuple of column indices to plot
+          tuple range: range ((*xmin*, *xmax*), (*ymin*, *ymax*)) covered by the
+                       cells. If given, data are binned on the fly; otherwise,
+                       points are buffered until their extent is known.
+          str title: density title
+
+        Returns:
+          the drawn :py:class:`Density`, which can be modifed afterwards as needed.
+        """
+        #pylint: disable=too-many-arguments,too-many-locals,redefined-builtin
+
+        with self.stats.timer("ingest"):
+            self.x._setup = False
+            self.y._setup = False
+
+            (scale_x, scale_y) = (self.x.scale, self.y.scale)
+            (nx, ny) = bins
+            counts = [0] * (nx * ny)
+
+            def _binning(x0, x1, y0, y1):
+                (sx, sy) = (nx / (x1-x0), ny / (y1-y0))
+                def _add(x, y):
+                    if x0 <= x <= x1 and y0 <= y <= y1:
+                        i = min(int((x-x0) * sx), nx-1)
+                        j = min(int((y-y0) * sy), ny-1)
+                        counts[j*nx + i] += 1
+                return _add
+
+            def _rows():
+                for row in data:
+                    try:
+                        yield (scale_x(row[col[0]]), scale_y(row[col[1]]))
+                    except (TypeError, IndexError):
+                        pass
+
+            npoints = 0
+            if range is not None:
+                range = ((scale_x(range[0][0]), scale_x(range[0][1])),
+                         (scale_y(range[1][0]), scale_y(range[1][1])))
+                add = _binning(range[0][0], range[0][1], range[1][0], range[1][1])
+                for (x, y) in _rows():
+                    add(x, y)
+                    npoints += 1
+            else:
+                xs = array.array("d")
+                ys = array.array("d")
+                for (x, y) in _rows():
+                    xs.append(x)
+                    ys.append(y)
+                npoints = len(xs)
+                if npoints > 0:
+                    range = ((min(xs), max(xs)), (min(ys), max(ys)))
+                    add = _binning(range[0][0], range[0][1], range[1][0], range[1][1])
+                    for (x, y) in zip(xs, ys):
+                        add(x, y)
+
+            density = self.density_type()
+            density.title = title
+            density.bins = (nx, ny)
+            density.range = range
+            density.counts = counts
+
+            if range is not None:
+                self.x.min = min(self.x.min, range[0][0])
+                self.x.max = max(self.x.max, range[0][1])
+                self.y.min = min(self.y.min, range[1][0])
+                self.y.max = max(self.y.max, range[1][1])
+
+            self.data_series.append(density)
+
+            self.stats.series += 1
+            self.stats.points += npoints
+        return density
+
+    def band(self, x, lo, hi, title=None):
+        """ Plot a band between lower and upper bounds
+
+        The band is drawn as a single filled area, which makes it suitable for
+        confidence intervals computed on many points.
+
+        Args:
+          x:  abscissae (sequence of numbers)
+          lo: lower bounds (sequence of numbers)
+          hi: upper bounds (sequence of numbers)
+          str title: band title
+
+        Returns:
+          the drawn :py:class:`Band`, which can be modifed afterwards as needed.
+        """
+        with self.stats.timer("ingest"):
+            self.x._setup = False
+            self.y._setup = False
+
+            (x, lo, hi) = (list(x), list(lo), list(hi))
+            if not len(x) == len(lo) == len(hi):
+                raise ValueError("Plotz error: band() got sequences of different lengths "
+                                 "(x: %d, lo: %d, hi: %d)" % (len(x), len(lo), len(hi)))
+
+            (xs, los, his) = self._bounds(x, lo, hi)
+
+            band = self.band_type()
+            band.title = title
+            band.color = next(self.line.color)
+            band.points = list(zip(xs, los, his))
+
+            self.data_series.append(band)
+
+            self.stats.series += 1
+            self.stats.points += len(band.points)
+        return band
+
+    def errorbar(self, x, y, err=None, title=None, lo=None, hi=None):
+        """ Plot error bars
+
+        Errors are given either as symmetric errors (*err*), or as lower and
+        upper errors (*lo* and *hi*). Each of them is a number (the same error
+        for all points) or a sequence of numbers (one error per point).
+
+        Args:
+          x: abscissae (sequence of numbers)
+          y: ordinates (sequence of numbers)
+          err: symmetric errors
+          str title: error bars title
+          lo: lower errors
+          hi: upper errors
+
+        Returns:
+          the drawn :py:class:`ErrorBars`, which can be modifed afterwards as
+          needed.
+        """
+        #pylint: disable=too-many-arguments
+        with self.stats.timer("ingest"):
+            self.x._setup = False
+            self.y._setup = False
+
+            if (lo is None, hi is None) != (err is not None, err is not None):
+                raise ValueError("Plotz error: errorbar() needs either err, or both lo and hi")
+            if err is not None:
+                (lo, hi) = (err, err)
+
+            (x, y) = (list(x), list(y))
+            lo = [lo] * len(y) if isinstance(lo, numbers.Number) else list(lo)
+            hi = [hi] * len(y) if isinstance(hi, numbers.Number) else list(hi)
+            if not len(x) == len(y) == len(lo) == len(hi):
+                raise ValueError("Plotz error: errorbar() got sequences of different lengths "
+                                 "(x: %d, y: %d, errors: %d, %d)"
+                                 % (len(x), len(y), len(lo), len(hi)))
+
+            lo = [v - e for (v, e) in zip(y, lo)]
+            hi = [v + e for (v, e) in zip(y, hi)]
+
+            (xs, los, his) = self._bounds(x, lo, hi)
+            ys = [self.y.scale(v) for v in y]
+
+            bars = self.errorbar_type()
+            bars.title = title
+            bars.color = next(self.line.color)
+            bars.points = list(zip(xs, ys, los, his))
+
+            self.data_series.append(bars)
+
+            self.stats.series += 1
+            self.stats.points += len(bars.points)
+        return bars
+
+    def _bounds(self, x, lo, hi):
+        """Scale abscissae and bounds, and update axes ranges in bulk"""
+        (scale_x, scale_y) = (self.x.scale, self.y.scale)
+        xs = [scale_x(v) for v in x]
+        los = [scale_y(v) for v in lo]
+        his = [scale_y(v) for v in hi]
+
+        if xs:
+            self.x.min = min(self.x.min, min(xs))
+            self.x.max = max(self.x.max, max(xs))
+        if los:
+            self.y.min = min(self.y.min, min(los), min(his))
+            self.y.max = max(self.y.max, max(los), max(his))
+        return (xs, los, his)
+
     def _update_histogram(self):
         if self.histogram.bins is None:
             for obj in self.data_series:
@@ -722,25 +1289,343 @@ class Plot(StrictPrototype):
             self.x.min = min(self.x.min, self.histogram.bins[0])
             self.x.max = max(self.x.max, self.histogram.bins[-1])
 
+    def _update_markers(self):
+        """Compute which points of each line get a marker
+
+        Markers filters are stateful. So that the plot can be rendered several
+        times (see :py:meth:`render_memory`) with the same result, array-based
+        filters are run on a fresh copy of themselves, and co-routine filters
+        (which can not be copied) are only sent the points they have not seen
+        yet."""
+        #pylint: disable=protected-access
+        for obj in self.data_series:
+            if isinstance(obj, self.line_type) and obj.markers is not None:
+                markers_filter = obj.markers_filter
+                if hasattr(markers_filter, "mask"):
+                    obj._markers_mask = obj._scaled_mask(
+                        self.size_x*self.scale / (self.x.max-self.x.min),
+                        self.size_y*self.scale / (self.y.max-self.y.min))
+                else:
+                    mask = obj._markers_mask or []
+                    obj._markers_mask = [
+                        (mask[i] if i < len(mask) else []) +
+                        [markers_filter.send(point) is not False
+                         for point in subline[len(mask[i]) if i < len(mask) else 0:]]
+                        for (i, subline) in enumerate(obj.points)
+                    ]
+
     def __enter__(self):
+        Manifest.record(self._inputs)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        Manifest.stop_recording(self._inputs)
+        if exc_type is not None:
+            return
+
+        generators = self._prepare()
+        if not generators:
+            return
+
+        with self.stats.timer("render"):
+            render(generators)
+
+        if self.stats_file:
+            self.stats.write(self.output + ".stats.json")
+
+    async def render_async(self, semaphore=None, log=None):
+        """Render the plot without blocking the event loop
+
+        This is the asynchronous counterpart of the end of a ``with`` block: TeX
+        engines are run as :py:mod:`asyncio` subprocesses, so that many figures
+        can be rendered concurrently from the same event loop.
+
+        Args:
+          semaphore: optional :py:class:`asyncio.Semaphore` limiting the number
+                     of concurrent TeX compilations. Share the same semaphore
+                     between plots to limit the global number of compilations.
+          log: optional callable (or coroutine function) called with the figure
+               basename and each line of TeX output
+        """
+        import asyncio #pylint: disable=import-outside-toplevel
+
+        # Checking dependencies and updating axes and markers may take a while
+        # on large data sets: this is done in a worker thread as well
+        generators = await asyncio.get_running_loop().run_in_executor(None, self._prepare)
+        if not generators:
+            return
+
+        with self.stats.timer("render"):
+            await render_async(generators, semaphore, log)
+
+        if self.stats_file:
+            self.stats.write(self.output + ".stats.json")
+
+    def render_memory(self, pdf=True, svg=False):
+        """Render the plot in memory
+
+        The figure is generated and compiled in a temporary directory (on a
+        tmpfs file system when one is available), and its contents are
+        returned instead of being written next to :py:attr:`output`. Variants
+        are not rendered. For example::
+
+            p = Plot("myname")
+            p.plot(...)
+            contents = p.render_memory(svg=True)
+            svg = contents["svg"]
+
+        Args:
+          bool pdf: compile the figure to pdf
+          bool svg: convert the compiled figure to svg
+
+        Returns:
+          a dictionary with items "tex" (TikZ code, as a string), "pdf" and
+          "svg" (as bytes, or None if they were not produced) and "files"
+          (auxiliary files such as raster images, as a dictionary of bytes
+          indexed by file name).
+        """
+        self._update()
+        with TmpDir(memory=True) as tmp:
+            gen = self._generator(Variant(os.path.join(tmp, os.path.basename(self.output))))
+            gen._name = self.output #pylint: disable=protected-access
+            with self.stats.timer("render"):
+                gen.generate()
+                return gen.contents(pdf, svg)
+
+    def _prepare(self):
+        """Prepare the plot for rendering
+
+        Returns:
+          the list of :py:class:`plotz.backend.TikzGenerator` objects rendering
+          all outputs, or an empty list if all outputs are up to date.
+        """
+        generators = ([self._generator()] +
+                      [self._generator(var) for var in self.variants])
+
+        if self.incremental and all(gen.manifest().up_to_date(self.preview, self.svg)
+                                    for gen in generators):
+            return []
+
+        self._update()
+        return generators
+
+    def _generator(self, variant=None):
+        """Renderer of the plot, or of one of its variants"""
+        return TikzGenerator(self, variant)
+
+    def _update(self):
+        """Update axes, legend and markers before rendering"""
         #pylint: disable=protected-access
+        with self.stats.timer("axes"):
+            self._update_histogram()
+
+            self.legend._update()
+            self.x._update()
+            self.y._update()
+
+            if self.x.pos is None:
+                self.x.pos = self.y.min
+
+            if self.y.pos is None:
+                self.y.pos = self.x.min
+
+        with self.stats.timer("markers"):
+            self._update_markers()
+
+
+class AsyncPlot(Plot):
+    """ :py:class:`Plot` rendered asynchronously
+
+    This object is supposed to be used in an ``async with`` statement::
+
+        async with AsyncPlot("myname") as p:
+            p.plot(...)
+
+            # the plot is rendered at the end of the block, without blocking
+            # the event loop
+
+    Args:
+      str output: basename of the output figure
+      semaphore:  optional :py:class:`asyncio.Semaphore` limiting the number
+                  of concurrent TeX compilations (see :py:meth:`Plot.render_async`)
+      log:        optional callable (or coroutine function) called with the
+                  figure basename and each line of TeX output
+    """
+    #pylint: disable=too-many-instance-attributes,too-few-public-methods
+    __slots__ = ("_semaphore", "_log")
+
+    def __init__(self, output, semaphore=None, log=None):
+        SlottedPrototype.__init__(self)
+        self._semaphore = semaphore
+        self._log = log
+        Plot.__init__(self, output)
+
+    async def __aenter__(self):
+        Manifest.record(self._inputs)
+        return self
 
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        Manifest.stop_recording(self._inputs)
         if exc_type is not None:
             return
 
-        self._update_histogram()
+        await self.render_async(self._semaphore, self._log)
+
+
+class Panel(Plot):
+    """ Panel of a :py:class:`Grid`
+
+    Panels are created by indexing a grid, and support all :py:class:`Plot`
+    methods and attributes, except those related to the output (which are
+    taken from the grid). Panels are rendered along with the grid: leaving a
+    ``with`` block using a panel does nothing.
+    """
+    #pylint: disable=too-many-instance-attributes,too-few-public-methods
+    __slots__ = ()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        Manifest.stop_recording(self._inputs)
+
+
+class Grid(Plot):
+    """ Grid of plots, rendered as a single figure
+
+    Panels of the grid are accessed by their (*row*, *column*) index, rows
+    being counted from the top. All panels are drawn in the same TikZ picture,
+    and the grid is compiled only once::
+
+        with Grid("myname", 2, 3, share_x=True) as g:
+            g[0, 0].plot(...)
+            g[1, 2].plot(...)
 
-        self.legend._update()
-        self.x._update()
-        self.y._update()
+            # the grid is actually generated at the end of the block
 
-        if self.x.pos is None:
-            self.x.pos = self.y.min
+    Output settings (:py:attr:`Plot.preview`, :py:attr:`Plot.engine`...),
+    variants, the style, title and legend belong to the grid. The legend
+    gathers the titled data series of all panels. :py:attr:`Plot.size_x` and
+    :py:attr:`Plot.size_y` define the size of the plotting area of each panel.
+
+    Args:
+      str output:   basename of the output figure
+      int rows:     number of rows
+      int cols:     number of columns
+      bool share_x: True if all panels share the same *x* axis
+      bool share_y: True if all panels share the same *y* axis
+    """
+    #pylint: disable=too-many-instance-attributes,too-few-public-methods
+    __slots__ = ("rows", "cols", "share_x", "share_y", "gap_x", "gap_y", "_panels")
 
-        if self.y.pos is None:
-            self.y.pos = self.x.min
+    def __init__(self, output, rows, cols, share_x=False, share_y=False):
+        #pylint: disable=too-many-arguments
+        SlottedPrototype.__init__(self)
 
-        TikzGenerator(self).run()
+        #: Number of rows
+        self.rows = rows
+
+        #: Number of columns
+        self.cols = cols
+
+        #: True if all panels share the same *x* axis
+        #:
+        #: Shared axes are the :py:attr:`Plot.x` and :py:attr:`Plot.y` axes of
+        #: the grid itself: their ranges cover the data of all panels, and their
+        #: ticks are computed once. Tick labels and axis labels are only drawn
+        #: on the outer panels (the bottom ones for *x*, the leftmost ones for
+        #: *y*).
+        self.share_x = share_x
+
+        #: True if all panels share the same *y* axis (see :py:attr:`share_x`)
+        self.share_y = share_y
+
+        #: Horizontal space between panels (in em)
+        self.gap_x = 1 if share_y else 5
+
+        #: Vertical space between panels (in em)
+        #:
+        #: This might have to be increased when panels have titles.
+        self.gap_y = 2 if share_x else 4
+
+        self._panels = {}
+
+        Plot.__init__(self, output)
+
+    def __getitem__(self, index):
+        """Panel at the given (*row*, *column*) index
+
+        Panels are created the first time they are accessed; grid cells which
+        are never accessed are left empty.
+        """
+        (i, j) = index
+        if not (0 <= i < self.rows and 0 <= j < self.cols):
+            raise IndexError("Plotz error: no panel (%d, %d) in a %dx%d grid"
+                             % (i, j, self.rows, self.cols))
+
+        panel = self._panels.get((i, j))
+        if panel is None:
+            panel = Panel(None)
+            panel.stats = self.stats
+            if self.share_x:
+                panel.x = self.x
+            if self.share_y:
+                panel.y = self.y
+            self._panels[(i, j)] = panel
+        return panel
+
+    def _data_series(self, method):
+        raise TypeError("Plotz error: data series are added to the panels of a grid, "
+                        "not to the grid itself (use grid[row, col].%s(...))" % method)
+
+    #pylint: disable=unused-argument,arguments-differ
+    def plot(self, *args, **kwargs):
+        """Not supported: data series belong to panels (see :py:meth:`__getitem__`)"""
+        self._data_series("plot")
+
+    def hist(self, *args, **kwargs):
+        """Not supported: data series belong to panels (see :py:meth:`__getitem__`)"""
+        self._data_series("hist")
+
+    def density(self, *args, **kwargs):
+        """Not supported: data series belong to panels (see :py:meth:`__getitem__`)"""
+        self._data_series("density")
+
+    def band(self, *args, **kwargs):
+        """Not supported: data series belong to panels (see :py:meth:`__getitem__`)"""
+        self._data_series("band")
+
+    def errorbar(self, *args, **kwargs):
+        """Not supported: data series belong to panels (see :py:meth:`__getitem__`)"""
+        self._data_series("errorbar")
+    #pylint: enable=unused-argument,arguments-differ
+
+    def panels(self):
+        """List of ((*row*, *column*), *panel*) pairs, in row-major order"""
+        return sorted(self._panels.items(), key=lambda item: item[0])
+
+    def _generator(self, variant=None):
+        return GridGenerator(self, variant)
+
+    def _update(self):
+        """Update axes (shared ones only once), legend and markers of all panels"""
+        #pylint: disable=protected-access
+        panels = [panel for (_, panel) in self.panels()]
+
+        with self.stats.timer("axes"):
+            self.legend._update()
+
+            axes = []
+            for panel in panels:
+                panel._update_histogram()
+                for axis in (panel.x, panel.y):
+                    if all(axis is not other for other in axes):
+                        axes.append(axis)
+
+            for axis in axes:
+                axis._update()
+
+        with self.stats.timer("markers"):
+            for panel in panels:
+                panel.size_x = self.size_x
+                panel.size_y = self.size_y
+                panel.scale = self.scale
+                panel.draft_points = self.draft_points
+                panel._update_markers()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of PlotZ, a plotting library
+#
+# Copyright (C) 2017
+#   F. Févotte     <fevotte@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+# The GNU General Public License is contained in the file COPYING.
+
+""" Command-line interface to PlotZ
+
+Usage: python -m plotz build [options] [paths...]
+       python -m plotz preview [options] [paths...]
+       python -m plotz external [options] document
+"""
+
+import sys
+import os
+import time
+import argparse
+import plotz.build
+
+def _build(args):
+    scripts = plotz.build.discover(args.paths, args.pattern)
+    if not scripts:
+        sys.stderr.write("No figure script found\n")
+        return 1
+
+    # Within scripts, only regenerate plots whose dependencies changed
+    env = {"PLOTZ_INCREMENTAL": "0" if args.force else "1"}
+    if args.preview is not None:
+        env["PLOTZ_PREVIEW"] = {"yes": "1", "no": "0"}.get(args.preview, args.preview)
+    if args.svg is not None:
+        env["PLOTZ_SVG"] = {"pdf": "1", "no": "0"}.get(args.svg, args.svg)
+
+    start = time.time()
+    jobs = plotz.build.build(scripts, jobs=args.jobs, timeout=args.timeout,
+                             force=args.force, env=env)
+    plotz.build.summary(jobs, time.time() - start)
+
+    return 0 if all(job.status in ("ok", "skipped") for job in jobs) else 1
+
+def _preview(args):
+    manifests = plotz.build.pending_previews(args.paths)
+
+    start = time.time()
+    failed = plotz.build.previews(manifests, jobs=args.jobs)
+    sys.stdout.write("\n%d previews (%d failed) in %.2fs\n"
+                     % (len(manifests), failed, time.time() - start))
+
+    return 0 if failed == 0 else 1
+
+def _external(args):
+    filename = args.document
+    if not filename.endswith(".plotz"):
+        filename = os.path.splitext(filename)[0] + ".plotz"
+    if not os.path.exists(filename):
+        sys.stderr.write("No externalization requests found in %s\n" % filename)
+        return 1
+
+    start = time.time()
+    (count, failed) = plotz.build.externals(filename, jobs=args.jobs)
+    sys.stdout.write("\n%d externalized figures (%d failed) in %.2fs\n"
+                     % (count, failed, time.time() - start))
+
+    return 0 if failed == 0 else 1
+
+def main(argv=None):
+    """Entry point of the PlotZ command-line interface"""
+    parser = argparse.ArgumentParser(prog="python -m plotz",
+                                     description="PlotZ figures generation")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    build = commands.add_parser("build", help="run figure scripts in parallel")
+    build.add_argument("paths", nargs="*", default=["."],
+                       help="figure scripts, or directories to search for them")
+    build.add_argument("-p", "--pattern", default="plot.py",
+                       help="name pattern of figure scripts (default: %(default)s)")
+    build.add_argument("-j", "--jobs", type=int, default=None,
+                       help="number of concurrent jobs (default: number of CPUs)")
+    build.add_argument("-t", "--timeout", type=float, default=None,
+                       help="maximum run time of each script, in seconds")
+    build.add_argument("-f", "--force", action="store_true",
+                       help="run scripts even if their outputs are up to date")
+    build.add_argument("--preview", choices=["yes", "no", "defer"], default=None,
+                       help="produce pdf previews, skip them or defer them")
+    build.add_argument("--svg", choices=["no", "pdf", "dvi"], default=None,
+                       help="produce svg versions of previews, converted from pdf "
+                       "or compiled through DVI")
+    build.set_defaults(func=_build)
+
+    preview = commands.add_parser("preview", help="produce deferred pdf previews")
+    preview.add_argument("paths", nargs="*", default=["."],
+                         help="directories to search for deferred previews")
+    preview.add_argument("-j", "--jobs", type=int, default=None,
+                         help="number of concurrent jobs (default: number of CPUs)")
+    preview.set_defaults(func=_preview)
+
+    external = commands.add_parser("external",
+                                   help="compile externalized figures requested by a document")
+    external.add_argument("document",
+                          help="LaTeX document (or the .plotz file produced by it)")
+    external.add_argument("-j", "--jobs", type=int, default=None,
+                          help="number of concurrent jobs (default: number of CPUs)")
+    external.set_defaults(func=_external)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
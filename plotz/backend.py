@@ -19,16 +19,18 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 # The GNU General Public License is contained in the file COPYING.
 
-""" TikZ backend and other internal functions for PlotZ """
-#pylint: disable=invalid-name
+""" TikZ backend and other internal functions for PlotZ
+
+Modules which are only needed to compile figures (subprocess, asyncio...) are
+imported by the functions using them, so that importing PlotZ stays cheap.
+"""
+#pylint: disable=invalid-name,import-outside-toplevel
 
 import sys
-import tempfile
-import shutil
+import math
 import os
-import subprocess
-import re
-from difflib import SequenceMatcher
+import time
+import contextlib
 
 def consumer(func):
     """Transform a generator function into a comsuming co-routine"""
@@ -50,6 +52,7 @@ class StrictPrototype(object):
     attributes with similar names.
     """
     #pylint: disable=too-few-public-methods
+    __slots__ = ()
 
     def __init__(self):
         object.__setattr__(self, "_init", True)
@@ -67,8 +70,16 @@ class StrictPrototype(object):
         except AttributeError as e:
             msg = e.args[0]
 
+        self._unknown_attribute(var, msg)
+
+    def _attributes(self):
+        """Names of the existing attributes"""
+        return list(self.__dict__)
+
+    def _unknown_attribute(self, var, msg):
+        from difflib import SequenceMatcher
         attrs = {}
-        for attr in self.__dict__:
+        for attr in self._attributes():
             attrs[attr] = SequenceMatcher(None, attr, var).ratio()
 
         fixit = ""
@@ -86,21 +97,557 @@ class StrictPrototype(object):
 
         raise AttributeError(msg)
 
+class SlottedPrototype(StrictPrototype):
+    """Strict prototype relying on ``__slots__``
+
+    Subclasses list all their attributes in ``__slots__``: writing to them does
+    not involve any check, while writing to other attributes raises the same
+    errors as :py:class:`StrictPrototype`. This is meant for objects whose
+    attributes are written in performance-critical code.
+
+    Instances of subclasses which do not define ``__slots__`` have a
+    ``__dict__``, which would accept any attribute: such subclasses get
+    checked as strictly as :py:class:`StrictPrototype` once initialized.
+    """
+    #pylint: disable=too-few-public-methods
+    __slots__ = ()
+
+    def __init__(self):
+        #pylint: disable=super-init-not-called
+        pass
+
+    def __init_subclass__(cls, **kwargs):
+        super(SlottedPrototype, cls).__init_subclass__(**kwargs)
+        if "__slots__" not in cls.__dict__:
+            cls.__setattr__ = SlottedPrototype._checked_setattr
+            cls._end_init = SlottedPrototype._checked_end_init
+
+    def _end_init(self):
+        pass
+
+    def _checked_end_init(self):
+        self.__dict__["_init"] = False
+
+    def _checked_setattr(self, var, val):
+        if self.__dict__.get("_init", True) or hasattr(self, var):
+            object.__setattr__(self, var, val)
+            return
+
+        self._unknown_attribute(var, "'%s' object has no attribute '%s'"
+                                % (type(self).__name__, var))
+
+    def __setattr__(self, var, val):
+        try:
+            object.__setattr__(self, var, val)
+            return
+        except AttributeError:
+            pass
+
+        self._unknown_attribute(var, "'%s' object has no attribute '%s'"
+                                % (type(self).__name__, var))
+
+    def _attributes(self):
+        attrs = [attr
+                 for cls in reversed(type(self).__mro__)
+                 for attr in cls.__dict__.get("__slots__", ())]
+        attrs += [attr
+                  for cls in reversed(type(self).__mro__)
+                  for (attr, value) in cls.__dict__.items() if isinstance(value, property)]
+        return attrs + [attr for attr in getattr(self, "__dict__", ()) if attr != "_init"]
+
+
+def _memory_dir(min_free=64 << 20):
+    """Directory backed by memory (tmpfs), or None if none is available
+
+    Args:
+      int min_free: minimal free space (in bytes) in the directory
+    """
+    directory = "/dev/shm"
+    try:
+        if os.path.isdir(directory) and os.access(directory, os.W_OK):
+            stat = os.statvfs(directory)
+            if stat.f_bavail * stat.f_frsize >= min_free:
+                return directory
+    except (AttributeError, OSError):
+        pass
+    return None
 
 class TmpDir(object):
     """Temporary directory
-Useable in a `with` statement. Automatically takes care of deleting itself."""
+Useable in a `with` statement. Automatically takes care of deleting itself.
+
+    Args:
+      bool memory: if True, the directory is created on a tmpfs file system
+                   (``/dev/shm``) when one is available
+    """
     #pylint: disable=too-few-public-methods
 
-    def __init__(self):
-        self._name = tempfile.mkdtemp(prefix="plotz")
+    def __init__(self, memory=False):
+        import tempfile
+        self._name = tempfile.mkdtemp(prefix="plotz",
+                                      dir=_memory_dir() if memory else None)
 
     def __enter__(self):
         return self._name
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        import shutil
         shutil.rmtree(self._name)
 
+def _md5(filename):
+    import hashlib
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class _HashedStream(object):
+    """Text stream wrapper, which updates a hash with everything written"""
+    #pylint: disable=too-few-public-methods
+
+    def __init__(self, stream, md5):
+        self._stream = stream
+        self._encoding = stream.encoding
+        self._md5 = md5
+
+    def write(self, data):
+        self._stream.write(data)
+        self._md5.update(data.encode(self._encoding))
+
+def _file_info(filename, previous=None):
+    """Identify the current state of a file by its mtime, size and md5 hash.
+
+    The hash is reused from a previous state if mtime and size did not change."""
+    stat = os.stat(filename)
+    info = {"mtime": stat.st_mtime, "size": stat.st_size}
+    if previous is not None and all(previous.get(k) == info[k] for k in info):
+        info["md5"] = previous["md5"]
+    else:
+        info["md5"] = _md5(filename)
+    return info
+
+def _file_unchanged(filename, info):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return False
+    if (stat.st_mtime, stat.st_size) == (info["mtime"], info["size"]):
+        return True
+    return stat.st_size == info["size"] and _md5(filename) == info["md5"]
+
+class Manifest(object):
+    """Dependency manifest of a PlotZ output
+
+    The manifest lists all files on which an output depends: the figure script,
+    data files read by :py:func:`plotz.DataFile`, additional dependencies
+    declared in :py:attr:`plotz.Plot.depends`, as well as ``plotz.sty`` and the
+    PlotZ python sources. It is stored in ``<output>.deps.json``, along with the
+    ``plotz.sty`` version.
+
+    Args:
+      str output: basename of the output figure
+      depends: additional dependencies
+      inputs: data files read by data generators for this output
+    """
+
+    #: Lists recording the files read by data generators (one per open plot)
+    _recorders = []
+
+    def __init__(self, output, depends=(), inputs=()):
+        self._output = output
+        self._filename = output + ".deps.json"
+
+        self.script = getattr(sys.modules.get("__main__"), "__file__", None)
+        if self.script is not None:
+            self.script = os.path.abspath(self.script)
+
+        files = [self.script] + list(inputs) + [os.path.abspath(f) for f in depends]
+        files += Manifest.plotz_files()
+        self.files = sorted(set(f for f in files if f is not None))
+
+    @classmethod
+    def record(cls, inputs):
+        """Start recording the files read by data generators
+
+        Args:
+          list inputs: list to which tracked files are appended
+        """
+        cls._recorders.append(inputs)
+
+    @classmethod
+    def stop_recording(cls, inputs):
+        """Stop recording files in a list passed to :py:meth:`record`"""
+        cls._recorders[:] = [rec for rec in cls._recorders if rec is not inputs]
+
+    @classmethod
+    def track(cls, filename):
+        """Declare a data file as a dependency of all plots being recorded"""
+        filename = os.path.abspath(filename)
+        for inputs in cls._recorders:
+            if filename not in inputs:
+                inputs.append(filename)
+
+    @staticmethod
+    def plotz_files():
+        """List the files making up PlotZ itself (python sources and LaTeX style)"""
+        root = os.path.dirname(os.path.abspath(__file__))
+        files = [os.path.join(root, f) for f in sorted(os.listdir(root)) if f.endswith(".py")]
+
+        sty = os.path.join(os.path.dirname(root), "plotz.sty")
+        if os.path.exists(sty):
+            files.append(sty)
+        return files
+
+    @staticmethod
+    def sty_version():
+        """Version of the ``plotz.sty`` file distributed along with this package"""
+        import re
+        for filename in Manifest.plotz_files():
+            if filename.endswith(".sty"):
+                with open(filename, "r") as f:
+                    match = re.search(r"\\ProvidesPackage\{plotz\}\[(.*?)\]", f.read())
+                if match:
+                    return match.group(1)
+        return None
+
+    @staticmethod
+    def load(filename):
+        """Load a manifest file
+
+        Returns:
+          the recorded manifest contents as a dictionary, or None if the manifest
+          can not be read.
+        """
+        import json
+        try:
+            with open(filename, "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def requested(environ):
+        """Production modes requested by the ``PLOTZ_PREVIEW`` and ``PLOTZ_SVG`` variables
+
+        Args:
+          dict environ: environment variables
+
+        Returns:
+          a (*preview*, *svg*) tuple of production modes (see
+          :py:attr:`plotz.Plot.preview` and :py:attr:`plotz.Plot.svg`), each of
+          them None if the corresponding variable is not set. Unknown values
+          are reported on stderr, and ignored.
+        """
+        def _mode(name, modes):
+            value = environ.get(name, "")
+            if value == "":
+                return None
+            if value not in modes:
+                sys.stderr.write("Plotz: ignoring %s=%s (expected one of: %s)\n"
+                                 % (name, value, ", ".join(sorted(modes))))
+                return None
+            return modes[value]
+
+        return (_mode("PLOTZ_PREVIEW", {"0": False, "1": True, "defer": "defer"}),
+                _mode("PLOTZ_SVG", {"0": False, "1": True, "dvi": "dvi"}))
+
+    @staticmethod
+    def fresh(recorded, preview=None, svg=None):
+        """Check whether a recorded manifest is still valid
+
+        A manifest is valid if none of the recorded dependencies changed, and all
+        recorded outputs still exist. When production modes are given, the
+        recorded run must also have produced (or deferred) what they require.
+
+        Args:
+          recorded: manifest contents, as returned by :py:meth:`load`
+          preview: requested production mode of the pdf preview, or None
+          svg: requested production mode of the svg version, or None
+        """
+        if recorded is None:
+            return False
+
+        if recorded.get("sty_version") != Manifest.sty_version():
+            return False
+
+        produced = recorded.get("preview")
+        if preview is True and produced is not True:
+            return False
+        if preview == "defer" and produced not in (True, "defer"):
+            return False
+        if svg and preview is not False and recorded.get("svg") != svg:
+            return False
+
+        for filename in recorded["outputs"]:
+            if not os.path.exists(filename):
+                return False
+
+        for filename, info in recorded["files"].items():
+            if not _file_unchanged(filename, info):
+                return False
+
+        return True
+
+    def up_to_date(self, preview=None, svg=None):
+        """Check whether the output is up to date with respect to its dependencies
+
+        Args:
+          preview: production mode of the pdf preview (see :py:meth:`fresh`)
+          svg: production mode of the svg version (see :py:meth:`fresh`)
+        """
+        if self.script is None:
+            return False
+
+        recorded = Manifest.load(self._filename)
+        if recorded is None or sorted(recorded["files"]) != self.files:
+            return False
+
+        return Manifest.fresh(recorded, preview, svg)
+
+    def externals(self):
+        """Externalized versions of the output recorded in the manifest
+
+        See :py:func:`update_externals`."""
+        return (Manifest.load(self._filename) or {}).get("external", [])
+
+    def write(self, outputs, preview=True, engine="pdflatex", svg=False):
+        """Record the current state of all dependencies
+
+        Args:
+          outputs: list of files generated for this output
+          preview: production mode of the pdf preview (see
+                   :py:attr:`plotz.Plot.preview`)
+          str engine: TeX engine with which the figure should be compiled
+          svg: production mode of the svg version of the figure (see
+               :py:attr:`plotz.Plot.svg`)
+        """
+        recorded = Manifest.load(self._filename) or {}
+        previous = recorded.get("files", {})
+        files = {}
+        for filename in self.files:
+            if os.path.exists(filename):
+                files[filename] = _file_info(filename, previous.get(filename))
+
+        manifest = {
+            "output": os.path.abspath(self._output),
+            "script": self.script,
+            "sty_version": Manifest.sty_version(),
+            "outputs": [os.path.abspath(f) for f in outputs if os.path.exists(f)],
+            "files": files,
+            "preview": preview,
+            "preview_pending": preview == "defer",
+            "engine": engine,
+            "svg": svg,
+            "external": recorded.get("external", []),
+        }
+        Manifest.save(self._filename, manifest)
+
+    @staticmethod
+    def save(filename, manifest):
+        """Save manifest contents (as returned by :py:meth:`load`) to a file"""
+        import json
+        with open(filename, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+class Stats(object):
+    """Timing and size statistics of a plot rendering
+
+    Wall times are given in seconds, sizes in bytes.
+    """
+
+    def __init__(self):
+        #: Wall time of each phase of the rendering pipeline
+        #:
+        #: - "ingest": reading and processing data (including the time spent in
+        #:   data generators such as :py:func:`plotz.DataFile`),
+        #: - "axes": computing axes ranges and ticks,
+        #: - "markers": running markers filters,
+        #: - "render": generating and compiling all outputs.
+        self.phases = {}
+
+        #: Number of data series
+        self.series = 0
+
+        #: Number of data points
+        self.points = 0
+
+        #: Per-output statistics, indexed by output basename
+        #:
+        #: - "emit": wall time of the TikZ code generation,
+        #: - "write": wall time of the ``.tex`` file writing,
+        #: - "tex_bytes": size of the ``.tex`` file,
+        #: - "compile": wall time of the pdf preview compilation,
+        #: - "tex_memory": TeX memory usage, as reported in the log file. Each
+        #:   entry gives the amount used and the capacity of a TeX memory area.
+        self.outputs = {}
+
+    def add(self, phase, duration):
+        """Accumulate time spent in a phase"""
+        self.phases[phase] = self.phases.get(phase, 0.) + duration
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Measure the time spent in a ``with`` block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start)
+
+    def output(self, name):
+        """Statistics dictionary for an output"""
+        return self.outputs.setdefault(name, {})
+
+    def as_dict(self):
+        """Statistics as a dictionary"""
+        return {
+            "phases": self.phases,
+            "series": self.series,
+            "points": self.points,
+            "outputs": self.outputs,
+        }
+
+    def write(self, filename):
+        """Write statistics in JSON format"""
+        import json
+        with open(filename, "w") as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def __repr__(self):
+        return "Stats(%r)" % self.as_dict()
+
+def _tex_memory(log):
+    """Parse TeX memory usage from a log file
+
+    Capacities extended at run time (such as ``5000000+600000``) are summed up.
+    Lines which do not follow the ``<used> <name> out of <capacity>`` pattern
+    (such as stack positions) are skipped.
+    """
+    import re
+    memory = {}
+    usage = re.compile(r"^\s*(\d+)\s+(.*?)\s+out of\s+(\d+)(?:\+(\d+))?\s*$")
+    try:
+        with open(log, "r", errors="replace") as f:
+            lines = iter(f)
+            for line in lines:
+                if line.startswith("Here is how much of TeX's memory you used:"):
+                    break
+            for line in lines:
+                if not line.strip():
+                    break
+                match = usage.match(line)
+                if match is None:
+                    continue
+                memory[match.group(2)] = [int(match.group(1)),
+                                          int(match.group(3)) + int(match.group(4) or 0)]
+    except (IOError, OSError):
+        pass
+    return memory
+
+
+class Raster(object):
+    """Pixel grid onto which data can be rasterized
+
+    Args:
+      int width:  width of the grid (in pixels)
+      int height: height of the grid (in pixels)
+      tuple x:    range (*xmin*, *xmax*) of the data covered by the grid
+      tuple y:    range (*ymin*, *ymax*) of the data covered by the grid
+      int brush:  size of the drawn points (in pixels)
+    """
+    #pylint: disable=too-many-arguments
+
+    def __init__(self, width, height, x, y, brush=1):
+        self.width = width
+        self.height = height
+        self._x0 = x[0]
+        self._y1 = y[1]
+        self._sx = width / float(x[1]-x[0])
+        self._sy = height / float(y[1]-y[0])
+        self._brush = brush
+
+        # Opacity of each pixel, top row first
+        self.alpha = bytearray(width * height)
+
+    def _pixel(self, x, y):
+        return (int((x-self._x0) * self._sx), int((self._y1-y) * self._sy))
+
+    def _dot(self, col, row):
+        width = self.width
+        col = min(max(col - self._brush//2, 0), width - self._brush)
+        row = min(max(row - self._brush//2, 0), self.height - self._brush)
+        for r in range(row, row+self._brush):
+            start = r*width + col
+            self.alpha[start:start+self._brush] = b"\xff" * self._brush
+
+    def points(self, points):
+        """Draw isolated points"""
+        for (x, y) in points:
+            self._dot(*self._pixel(x, y))
+
+    def polyline(self, points):
+        """Draw a polyline joining points"""
+        points = iter(points)
+        (col0, row0) = self._pixel(*next(points))
+        self._dot(col0, row0)
+        for point in points:
+            (col1, row1) = self._pixel(*point)
+            steps = max(abs(col1-col0), abs(row1-row0))
+            for i in range(1, steps+1):
+                self._dot(col0 + (col1-col0)*i//steps, row0 + (row1-row0)*i//steps)
+            (col0, row0) = (col1, row1)
+
+    def write(self, filename, color):
+        """Write the raster to a PNG file
+
+        Args:
+          str filename: name of the PNG file
+          str color: hexadecimal RGB color of the drawn pixels
+        """
+        n = self.width * self.height
+        rgba = bytearray(4 * n)
+        for (i, c) in enumerate(bytearray.fromhex(color)):
+            rgba[i::4] = bytes(bytearray([c])) * n
+        rgba[3::4] = self.alpha
+
+        _write_png(filename, self.width, self.height, rgba)
+
+def _write_png(filename, width, height, rgba):
+    """Write an RGBA image to a PNG file
+
+    Args:
+      str filename: name of the PNG file
+      int width:    image width (in pixels)
+      int height:   image height (in pixels)
+      rgba:         pixels data, row by row from the top of the image
+    """
+    import struct
+    import zlib
+    stride = 4 * width
+    raw = b"".join(b"\x00" + bytes(rgba[i:i+stride]) for i in range(0, len(rgba), stride))
+
+    def _chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data
+                + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(_chunk(b"IDAT", zlib.compress(raw, 6)))
+        f.write(_chunk(b"IEND", b""))
+
+def _interpolate(colors, t):
+    """Color at position *t* (between 0 and 1) in a list of hexadecimal RGB colors"""
+    colors = [bytearray.fromhex(c) for c in colors]
+    pos = t * (len(colors) - 1)
+    i = min(int(pos), len(colors) - 2)
+    frac = pos - i
+    return "".join("%02X" % int(round(a + (b-a)*frac))
+                   for (a, b) in zip(colors[i], colors[i+1]))
+
+
 class LatexOutput(object):
     """Collection of LaTeX lines
 
@@ -169,6 +716,34 @@ class LatexOutput(object):
 
         return self
 
+    def size(self, key):
+        """Number of contents appended at an insertion point
+
+        Args:
+          str key: identifier for the insertion point
+        """
+        (lines, _) = self._get_key(key)
+        return len(lines)
+
+    def wrap(self, key, start, before, after):
+        """Wrap contents appended at an insertion point
+
+        Args:
+          str key:    identifier for the insertion point
+          int start:  size of the insertion point (see :py:meth:`size`) before
+                      the contents to be wrapped were appended
+          str before: string inserted before the contents
+          str after:  string inserted after the contents
+
+        Returns:
+          the LatexOutput object itself, in order to be able to chain method calls.
+        """
+        (lines, _) = self._get_key(key)
+        if len(lines) > start:
+            lines[start:] = [before, lines[start:], after]
+
+        return self
+
     def write(self, stream):
         """Write the LaTeX document to a stream.
 
@@ -186,13 +761,531 @@ class LatexOutput(object):
             _write(stream, l, "")
 
 
+#: Supported TeX engines, along with the command-line options they are run with
+ENGINES = {
+    "pdflatex": ["-file-line-error"],
+    "lualatex": ["-file-line-error"],
+    "xelatex":  ["-file-line-error"],
+}
+
+#: Commands running TeX engines in DVI mode, along with the extension of the
+#: files they produce
+DVI_ENGINES = {
+    "pdflatex": (["latex"], "dvi"),
+    "lualatex": (["dvilualatex"], "dvi"),
+    "xelatex":  (["xelatex", "-no-pdf"], "xdv"),
+}
+
+class _TexRun(object):
+    """Compilation of a PlotZ figure in a standalone document
+
+    The TeX process itself is run by the caller, either synchronously or
+    asynchronously; this object prepares the compilation, analyzes the TeX
+    output line by line, and collects the results.
+
+    Args:
+      str tmp: temporary directory in which the compilation takes place
+      (see :py:func:`_compile` for the other arguments)
+    """
+    #pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    def __init__(self, tmp, output, keys="", preamble="", engine="pdflatex", options=(),
+                 dvi=False):
+        import re
+        (directory, name) = os.path.split(os.path.abspath(output))
+
+        # The standalone document finds the figure in its final location
+        self.env = dict(os.environ)
+        self.env["TEXINPUTS"] = os.pathsep.join([".", directory, self.env.get("TEXINPUTS", "")])
+
+        # The name of the driver document can not collide with the figure's
+        self.job = name + "-plotz-driver"
+        with open(os.path.join(tmp, self.job + ".tex"), "w") as f:
+            f.write("%\n".join([
+                r"\errorstopmode",
+                # Figures compiled to DVI are converted to svg by dvisvgm: TikZ
+                # and graphicx (which includes raster images) emit its specials.
+                # XeTeX always uses its own graphics driver.
+                r"\def\pgfsysdriver{pgfsys-dvisvgm.def}" if dvi else "",
+                r"\PassOptionsToPackage{dvisvgm}{graphicx}" if dvi and engine != "xelatex" else "",
+                r"\documentclass{standalone}",
+                r"\usepackage{plotz}",
+                preamble,
+                r"\begin{document}",
+                r"\plotz[%s]{%s}" % (keys, name),
+                r"\makeatletter",
+                r"\ifdefined\plotz@sizex",
+                r"  \typeout{plotz-decorations: "
+                r"\the\dimexpr\wd\plotz@box-\plotz@sizex pt\relax,"
+                r"\the\dimexpr\ht\plotz@box-\plotz@sizey pt\relax}",
+                r"\fi",
+                r"\end{document}",
+            ]))
+
+        self.tmp = tmp
+        self.dvi = dvi
+        if dvi:
+            (command, self.ext) = DVI_ENGINES[engine]
+        else:
+            (command, self.ext) = ([engine], "pdf")
+        self.command = command + ENGINES[engine] + list(options) + [self.job + ".tex"]
+        self.start = time.time()
+
+        self._context = 0
+        self._error = re.compile(r"^.+:\d+: ")
+        self._size = re.compile(r"^plotz-decorations: (-?[\d.]+)pt,(-?[\d.]+)pt")
+        self.capacity_exceeded = False
+        self.decorations = None
+
+    def line(self, line):
+        """Analyze a line of TeX output; errors are reported on stderr"""
+        match = self._size.match(line)
+        if match:
+            self.decorations = match.groups()
+        if self._error.match(line):
+            self._context = max(self._context, 3)
+        if "TeX capacity exceeded" in line:
+            self.capacity_exceeded = True
+        if self._context > 0:
+            sys.stderr.write(line)
+            self._context -= 1
+
+    def finish(self, target, info=None):
+        """Collect the compilation results (see :py:func:`_compile`)"""
+        import shutil
+        import subprocess
+        if info is not None:
+            info["compile"] = time.time() - self.start
+            info["tex_memory"] = _tex_memory(os.path.join(self.tmp, self.job + ".log"))
+            info["capacity_exceeded"] = self.capacity_exceeded
+
+        result = os.path.join(self.tmp, self.job + "." + self.ext)
+        if self.dvi and os.path.exists(result):
+            with open(os.devnull, "w") as devnull:
+                subprocess.call(["dvisvgm", "--no-fonts", "--output=%s.svg" % self.job,
+                                 os.path.basename(result)],
+                                cwd=self.tmp, stdout=devnull, stderr=devnull)
+            result = os.path.join(self.tmp, self.job + ".svg")
+
+        if os.path.exists(result):
+            shutil.move(result, target)
+            return (True, self.decorations)
+
+        return (False, None)
+
+def _compile(output, target, keys="", preamble="", info=None, engine="pdflatex", options=(),
+             dvi=False):
+    """Compile a PlotZ figure in a standalone document
+
+    The figure is compiled to *target*: a pdf file, or an svg file if *dvi* is
+    True.
+
+    Returns:
+      a tuple (*success*, *decorations*), where *decorations* is the size of
+      the figure decorations (as a pair of strings), or None if it could not be
+      measured.
+    """
+    #pylint: disable=too-many-arguments
+    import subprocess
+    with TmpDir(memory=True) as tmp:
+        run = _TexRun(tmp, output, keys, preamble, engine, options, dvi)
+        pdflatex = subprocess.Popen(run.command,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    stdin=subprocess.PIPE, cwd=tmp, env=run.env)
+        pdflatex.stdin.close()
+        for line in pdflatex.stdout:
+            run.line(line.decode())
+        pdflatex.stdout.close()
+        pdflatex.wait()
+        return run.finish(target, info)
+
+async def _compile_async(output, pdf, info=None, engine="pdflatex", options=(), log=None):
+    """Asynchronous version of :py:func:`_compile`
+
+    Args:
+      log: if given, callable (or coroutine function) called with the figure
+           basename and each line of TeX output
+    """
+    #pylint: disable=too-many-arguments
+    import asyncio
+    import inspect
+    with TmpDir(memory=True) as tmp:
+        run = _TexRun(tmp, output, engine=engine, options=options)
+        pdflatex = await asyncio.create_subprocess_exec(
+            *run.command,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+            stdin=asyncio.subprocess.DEVNULL, cwd=tmp, env=run.env)
+        async for line in pdflatex.stdout:
+            line = line.decode()
+            run.line(line)
+            if log is not None:
+                result = log(output, line)
+                if inspect.isawaitable(result):
+                    await result
+        await pdflatex.wait()
+        return run.finish(pdf, info)
+
+def _record_decorations(output, decorations):
+    """Record the size of decorations, so that \\plotz can compute scales
+    without iterating"""
+    with open(output+".tex", "a") as f:
+        f.write("%\n".join([
+            r"\makeatletter",
+            r"\def\plotz@decox{%s}" % decorations[0],
+            r"\def\plotz@decoy{%s}" % decorations[1],
+            r"\makeatother",
+        ]) + "%\n")
+
+def compile_preview(output, info=None, engine="pdflatex", options=()):
+    """Compile a PlotZ figure to produce a pdf preview
+
+    Args:
+      str output: basename of the figure. ``<output>.tex`` is compiled to
+                  produce ``<output>.pdf``
+      dict info:  if given, this dictionary is filled with the compilation
+                  time ("compile"), TeX memory usage ("tex_memory") and
+                  whether TeX capacity was exceeded ("capacity_exceeded")
+      str engine: TeX engine (see :py:data:`ENGINES`)
+      options:    additional command-line options for the TeX engine
+
+    Returns:
+      True if the preview was successfully produced
+    """
+    (success, decorations) = _compile(output, output+".pdf",
+                                      info=info, engine=engine, options=options)
+    if success and decorations is not None:
+        _record_decorations(output, decorations)
+    return success
+
+async def compile_preview_async(output, info=None, engine="pdflatex", options=(), log=None):
+    """Asynchronous version of :py:func:`compile_preview`
+
+    The TeX engine is run as an :py:mod:`asyncio` subprocess, whose output is
+    analyzed as it is produced.
+
+    Args:
+      log: if given, callable (or coroutine function) called with the figure
+           basename and each line of TeX output
+      (see :py:func:`compile_preview` for the other arguments)
+
+    Returns:
+      True if the preview was successfully produced
+    """
+    #pylint: disable=too-many-arguments
+    (success, decorations) = await _compile_async(output, output+".pdf", info,
+                                                  engine, options, log)
+    if success and decorations is not None:
+        _record_decorations(output, decorations)
+    return success
+
+
+def convert_svg(pdf, svg):
+    """Convert a pdf file to svg
+
+    ``pdf2svg`` is used if it is available, ``dvisvgm`` otherwise.
+
+    Args:
+      str pdf: input pdf file
+      str svg: output svg file
+
+    Returns:
+      True if the conversion succeeded
+    """
+    import shutil
+    import subprocess
+    if shutil.which("pdf2svg") is not None:
+        command = ["pdf2svg", pdf, svg]
+    elif shutil.which("dvisvgm") is not None:
+        command = ["dvisvgm", "--pdf", "--no-fonts", "--output=" + svg, pdf]
+    else:
+        sys.stderr.write("Plotz: no pdf to svg converter found (pdf2svg or dvisvgm)\n")
+        return False
+
+    with open(os.devnull, "w") as devnull:
+        subprocess.call(command, stdout=devnull, stderr=devnull)
+    return os.path.exists(svg)
+
+
+def compile_svg(output, info=None, engine="pdflatex", options=()):
+    """Compile a PlotZ figure to DVI, and convert it to svg using dvisvgm
+
+    Args:
+      str output: basename of the figure. ``<output>.tex`` is compiled to
+                  produce ``<output>.svg``
+      (see :py:func:`compile_preview` for the other arguments)
+
+    Returns:
+      True if the svg file was successfully produced
+    """
+    import shutil
+    if shutil.which("dvisvgm") is None:
+        sys.stderr.write("Plotz: dvisvgm not found, could not produce %s.svg\n" % output)
+        return False
+
+    (success, _) = _compile(output, output+".svg", info=info, engine=engine,
+                            options=options, dvi=True)
+    return success
+
+def make_svg(output, mode, engine="pdflatex", options=()):
+    """Produce the svg version of a figure
+
+    Args:
+      str output: basename of the figure
+      mode:       "dvi" to compile the figure to DVI and convert it using
+                  :py:func:`compile_svg`, or True to convert the pdf preview
+                  using :py:func:`convert_svg`
+      (see :py:func:`compile_preview` for the other arguments)
+
+    Returns:
+      True if the svg file was successfully produced
+    """
+    if mode == "dvi":
+        return compile_svg(output, engine=engine, options=options)
+    if os.path.exists(output+".pdf"):
+        return convert_svg(output+".pdf", output+".svg")
+    return False
+
+
+def external_pdf(output, stamp, key):
+    """Name of an externalized pdf version of a figure
+
+    Args:
+      str output: basename of the figure
+      str stamp:  stamp of the ``<output>.tex`` file contents
+      str key:    hash of the ``\\plotz`` options
+    """
+    return "%s-external-%s-%s.pdf" % (output, stamp, key)
+
+def read_stamp(output):
+    """Stamp of the ``<output>.tex`` file contents, or None if it has none"""
+    import re
+    try:
+        with open(output+".tex", "rb") as f:
+            f.seek(max(0, os.path.getsize(output+".tex") - 4096))
+            match = re.search(br"\\def\\plotz@stamp\{([0-9a-f]+)\}", f.read())
+    except (IOError, OSError):
+        return None
+    if match is None:
+        return None
+    return match.group(1).decode()
+
+def compile_external(output, keys, key, preamble="", engine="pdflatex", options=()):
+    """Compile an externalized pdf version of a figure
+
+    Externalized figures are included as is by ``\\plotz`` in documents loading
+    the ``plotz`` package with the ``external`` option. One such pdf is
+    produced for each set of ``\\plotz`` options used in documents.
+
+    Args:
+      str output:   basename of the figure
+      str keys:     ``\\plotz`` options, with all sizes expressed in points
+      str key:      hash of *keys*, as computed by ``\\plotz``
+      str preamble: additional preamble of the standalone document
+      str engine:   TeX engine (see :py:data:`ENGINES`)
+      options:      additional command-line options for the TeX engine
+
+    Returns:
+      True if the pdf was successfully produced
+    """
+    #pylint: disable=too-many-arguments
+    stamp = read_stamp(output)
+    if stamp is None:
+        return False
+
+    (success, _) = _compile(output, external_pdf(output, stamp, key), keys, preamble,
+                            engine=engine, options=options)
+    return success
+
+def update_externals(output, externals, engine="pdflatex", options=()):
+    """Bring externalized pdf versions of a figure up to date
+
+    Outdated externalized pdfs are removed, and new ones are compiled for all
+    sets of ``\\plotz`` options previously used.
+
+    Args:
+      str output: basename of the figure
+      externals:  list of externalized versions, as recorded in the dependency
+                  manifest: dictionaries with "keys", "key" and "preamble" items
+      str engine: TeX engine (see :py:data:`ENGINES`)
+      options:    additional command-line options for the TeX engine
+    """
+    import glob
+    stamp = read_stamp(output)
+    for pdf in glob.glob(glob.escape(output) + "-external-*.pdf"):
+        if stamp is None or not pdf.startswith("%s-external-%s-" % (output, stamp)):
+            os.remove(pdf)
+
+    if stamp is None:
+        return
+
+    for external in externals:
+        if not os.path.exists(external_pdf(output, stamp, external["key"])):
+            compile_external(output, external["keys"], external["key"],
+                             external.get("preamble", ""), engine, options)
+
+
+def _decimate(points, factor):
+    """Keep one point in *factor*, as well as the last one"""
+    if factor == 1 or len(points) <= 2:
+        return points
+
+    decimated = points[::factor]
+    if (len(points)-1) % factor != 0:
+        decimated.append(points[-1])
+    return decimated
+
+def _m4(points, xmin, xmax, columns):
+    """Downsample a polyline, keeping at most 4 points per column (M4 algorithm)
+
+    The range [*xmin*, *xmax*] is divided into *columns* columns. For each run
+    of consecutive points falling in the same column, the first and last
+    points are kept, along with the points of minimal and maximal ordinates.
+    Drawn at the resolution of columns, the downsampled polyline looks the same
+    as the original one.
+
+    Args:
+      points: list of (*x*, *y*) points
+      float xmin, xmax: range of abscissae
+      int columns: number of columns
+
+    Returns:
+      the list of (*first*, *low*, *high*, *last*) indices of points in each
+      run
+    """
+    runs = []
+    if not points:
+        return runs
+
+    scale = columns / (xmax - xmin)
+    current = None
+    (low, high, ylow, yhigh, first) = (0, 0, 0., 0., 0)
+    for (i, (x, y)) in enumerate(points):
+        column = int((x - xmin) * scale)
+        if column != current:
+            if current is not None:
+                runs.append((first, low, high, i-1))
+            current = column
+            (first, low, high, ylow, yhigh) = (i, i, i, y, y)
+        elif y < ylow:
+            (low, ylow) = (i, y)
+        elif y > yhigh:
+            (high, yhigh) = (i, y)
+    runs.append((first, low, high, len(points)-1))
+    return runs
+
+def render(generators):
+    """Render several outputs of the same plot
+
+    TikZ code is generated sequentially for all outputs, then compiled
+    concurrently. If any compilation fails, the first error is raised once all
+    of them are over.
+
+    Args:
+      generators: list of :py:class:`TikzGenerator` objects
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    for gen in generators:
+        gen.generate()
+
+    if not generators:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, len(generators)-1)) as pool:
+        futures = [pool.submit(gen.compile) for gen in generators[1:]]
+        # Leaving the pool waits for all variants, even if the main output fails
+        generators[0].compile()
+
+    for future in futures:
+        future.result()
+
+
+async def render_async(generators, semaphore=None, log=None):
+    """Asynchronous version of :py:func:`render`
+
+    TikZ code is generated in a worker thread, so that the event loop is not
+    blocked. All outputs are then compiled concurrently.
+
+    Args:
+      generators: list of :py:class:`TikzGenerator` objects
+      semaphore: optional :py:class:`asyncio.Semaphore` limiting the number of
+                 concurrent TeX compilations
+      log: optional callable (or coroutine function) called with the figure
+           basename and each line of TeX output
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    for gen in generators:
+        await loop.run_in_executor(None, gen.generate)
+
+    await asyncio.gather(*[gen.compile_async(semaphore, log) for gen in generators])
+
+
 class TikzGenerator(object):
-    """ Plot renderer: this helper class generates the TikZ code for a plot """
+    """ Plot renderer: this helper class generates the TikZ code for a plot
+
+    Args:
+      plot: the :py:class:`plotz.Plot` to render
+      variant: optional :py:class:`plotz.Variant`, overriding some settings of
+               the plot
+    """
     #pylint: disable=too-few-public-methods, too-many-instance-attributes
 
-    def __init__(self, plot):
+    #: Maximal decimation of lines (as a power of 2) when TeX capacity is exceeded
+    MAX_DECIMATION = 6
+
+    def __init__(self, plot, variant=None):
         self._plot = plot
 
+        def _setting(name):
+            value = getattr(variant, name, None)
+            if value is None:
+                value = getattr(plot, name)
+            return value
+
+        self._output = _setting("output")
+        self._style = _setting("style")
+
+        # Name of the output in the plot statistics
+        self._name = self._output
+        self._scale = _setting("scale")
+        self._size_x = _setting("size_x")
+        self._size_y = _setting("size_y")
+
+        # Only one in `_decimate` data points is output for lines
+        self._decimate = 1
+
+        self._latex = None
+        self._legend_shift = None
+        self._rasters = None
+        self._densities = None
+        self._nbars = None
+
+        # Auxiliary files produced along with the TikZ code
+        self._files = []
+
+    def run(self):
+        """Actually generate the TikZ code for a plot, and compile it to produce a pdf preview"""
+        self.generate()
+        self.compile()
+
+    def generate(self):
+        """Generate the TikZ code for a plot"""
+        start = time.time()
+        self._generate()
+        self._plot.stats.output(self._name)["emit"] = time.time() - start
+
+    def _generate(self):
+        self._skeleton()
+        self._define_styles()
+        self._size()
+        self._title()
+        self._contents()
+        self._legend()
+
+        self._latex.append("/foreground/user", self._plot.tikz)
+
+    def _skeleton(self):
+        """Start a new LaTeX output, with all insertion points"""
         self._latex = (
             LatexOutput()
             .insert("/header")
@@ -205,8 +1298,15 @@ class TikzGenerator(object):
             .insert("/background/bbox")
             .insert("/background/grid")
             .insert("/background/legend")
+            # Full-resolution lines are not defined in draft mode. The
+            # \ifplotz@fulllines conditional is looked up by name, so that the
+            # figure can still be read by versions of plotz.sty without it.
             .insert("/lines",
-                    r"\def\plotz@lines{", "}")
+                    r"\csname\expandafter\ifx\csname ifplotz@fulllines\endcsname\relax"
+                    r" iftrue\else ifplotz@fulllines\fi\endcsname"
+                    r"\def\plotz@lines{", r"}\fi")
+            .insert("/linesdraft",
+                    r"\def\plotz@linesdraft{", "}")
             .insert("/foreground",
                     r"\def\plotz@foreground{", "}")
             .insert("/foreground/axes")
@@ -218,24 +1318,22 @@ class TikzGenerator(object):
                     r"\def\plotz@legendmargin{", "}")
             .insert("/scale"))
 
-        self._color = None
-        self._marker = None
-        self._pattern = None
-        self._thickness = None
-
         self._legend_shift = iter(range(100))
+        self._rasters = iter(range(100))
+        self._densities = iter(range(100))
+        self._files = []
 
-        self._nbars = None
-
+    def _contents(self, labels=(True, True)):
+        """Generate the contents of the plotting area: axes, grid and data series
 
-    def run(self):
-        """Actually generate the TikZ code for a plot, and compile it to produce a pdf preview"""
-        self._style()
-        self._size()
-        self._title()
+        Args:
+          labels: tuple of booleans, telling whether tick labels and axis
+                  labels should be drawn for the *x* and *y* axes
+        """
+        self._bbox()
 
-        self._axis(self._plot.x)
-        self._axis(self._plot.y)
+        self._axis(self._plot.x, labels[0])
+        self._axis(self._plot.y, labels[1])
 
         self._grid()
 
@@ -252,26 +1350,233 @@ class TikzGenerator(object):
             if isinstance(obj, self._plot.bar_type):
                 self._bar(obj, next(ibar))
 
-        self._legend()
+            if isinstance(obj, self._plot.density_type):
+                self._density(obj)
 
-        self._latex.append("/foreground/user", self._plot.tikz)
-        self._compile()
+            if isinstance(obj, self._plot.band_type):
+                self._band(obj)
+
+            if isinstance(obj, self._plot.errorbar_type):
+                self._errorbar(obj)
+
+    def compile(self):
+        """Write the TikZ code and compile it to produce a pdf preview
+
+        Depending on :py:attr:`plotz.Plot.preview`, the pdf preview might not be
+        produced, or be deferred to a later batch step."""
+        stats = self._write_output()
 
+        if self._plot.preview is True:
+            engine = stats["engine"]
+            compile_preview(self._output, stats, engine, self._engine_options(engine))
+            if stats["capacity_exceeded"]:
+                self._fallback(stats)
+            self._svg(stats, self._plot.svg)
+
+        self._finish(stats)
+
+    async def compile_async(self, semaphore=None, log=None):
+        """Asynchronous version of :py:meth:`compile`
+
+        Args:
+          semaphore: optional :py:class:`asyncio.Semaphore` limiting the number
+                     of concurrent TeX compilations
+          log: optional callable (or coroutine function) called with the figure
+               basename and each line of TeX output
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        stats = await loop.run_in_executor(None, self._write_output)
+
+        if self._plot.preview is True:
+            if semaphore is None:
+                await self._preview_async(stats, log)
+            else:
+                async with semaphore:
+                    await self._preview_async(stats, log)
+
+        await loop.run_in_executor(None, self._finish, stats)
+
+    async def _preview_async(self, stats, log):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        engine = stats["engine"]
+        await compile_preview_async(self._output, stats, engine,
+                                    self._engine_options(engine), log)
+        if stats["capacity_exceeded"]:
+            await loop.run_in_executor(None, self._fallback, stats)
+        await loop.run_in_executor(None, self._svg, stats, self._plot.svg)
+
+    def contents(self, pdf=True, svg=False):
+        """Write and compile the figure, and read back the produced files
+
+        Args:
+          bool pdf: compile the figure to pdf
+          bool svg: convert the compiled figure to svg
+
+        Returns:
+          a dictionary with the following items:
+          - "tex": TikZ code of the figure (as a string)
+          - "pdf": compiled figure (as bytes), or None
+          - "svg": figure converted to svg (as bytes), or None
+          - "files": auxiliary files needed by the TikZ code (such as raster
+            images), as a dictionary of bytes indexed by file name
+        """
+        stats = self._write_output()
+
+        contents = {"pdf": None, "svg": None}
+        dvi = svg and self._plot.svg == "dvi"
+        if pdf or (svg and not dvi):
+            engine = stats["engine"]
+            compile_preview(self._output, stats, engine, self._engine_options(engine))
+            if stats["capacity_exceeded"]:
+                self._fallback(stats)
+
+        # In DVI mode, the svg version is compiled on its own
+        if svg:
+            self._svg(stats, "dvi" if dvi else True)
+
+        for ext in contents:
+            if os.path.exists(self._output + "." + ext):
+                with open(self._output + "." + ext, "rb") as f:
+                    contents[ext] = f.read()
+
+        with open(self._output + ".tex", "r") as f:
+            contents["tex"] = f.read()
+
+        contents["files"] = {}
+        for filename in self._files:
+            with open(filename, "rb") as f:
+                contents["files"][os.path.basename(filename)] = f.read()
+
+        return contents
+
+    def _svg(self, stats, mode):
+        """Produce the svg version of the figure (see :py:attr:`plotz.Plot.svg`)"""
+        if not mode:
+            return
+
+        start = time.time()
+        engine = stats.get("fallback_engine", stats["engine"])
+        make_svg(self._output, mode, engine, self._engine_options(engine))
+        stats["svg"] = time.time() - start
+
+    def _write_output(self):
+        """Write the TikZ code, and initialize statistics of the output"""
+        stats = self._plot.stats.output(self._name)
+
+        start = time.time()
+        self._write()
+        stats["write"] = time.time() - start
+        stats["tex_bytes"] = os.path.getsize(self._output + ".tex")
+        stats["engine"] = self.engine()
+        return stats
+
+    def _finish(self, stats):
+        """Update externalized versions of the figure and the dependency manifest"""
+        preview = self._plot.preview
+        engine = stats.get("fallback_engine", stats["engine"])
+        manifest = self.manifest()
+        externals = manifest.externals()
+        if externals:
+            if preview is True:
+                update_externals(self._output, externals, engine,
+                                 self._engine_options(engine))
+            else:
+                update_externals(self._output, [])
 
-    def _style(self):
-        self._define_style(self._plot.style.color,
+        # The svg version is only produced along with the pdf preview
+        svg = self._plot.svg if preview else False
+        manifest.write([self._output+".tex", self._output+".pdf"] + self._files +
+                       ([self._output+".svg"] if svg else []),
+                       preview=preview, engine=engine, svg=svg)
+
+    def engine(self):
+        """TeX engine used to compile the plot (see :py:attr:`plotz.Plot.engine`)"""
+        plot = self._plot
+        if plot.engine == "auto":
+            if self._emitted_points() > plot.engine_threshold:
+                return "lualatex"
+            return "pdflatex"
+        if plot.engine not in ENGINES:
+            raise ValueError("Plotz error: unknown TeX engine '%s' (valid engines: %s)"
+                             % (plot.engine, ", ".join(["auto"] + sorted(ENGINES))))
+        return plot.engine
+
+    def _emitted_points(self):
+        """Number of line coordinates in the TikZ code of the plot"""
+        return self._line_coordinates(self._plot)
+
+    def _line_coordinates(self, plot):
+        # Rasterized lines are drawn as images, and downsampled lines get at
+        # most 4 points per column of the plotting area
+        columns = max(1, int(math.ceil(self._size_x*self._scale)))
+        npoints = 0
+        for obj in plot.data_series:
+            if isinstance(obj, plot.line_type) and not obj.raster:
+                if obj.envelope:
+                    npoints += sum(min(len(subline), 4*columns) for subline in obj.points)
+                else:
+                    npoints += sum(len(subline) for subline in obj.points)
+        return npoints
+
+    def _engine_options(self, engine):
+        return self._plot.engine_options.get(engine, [])
+
+    def _fallback(self, stats):
+        """Try and compile figures which exceed TeX capacity
+
+        LuaLaTeX is tried first, since it allocates memory dynamically. If it is
+        not available (or if it fails too), lines data are progressively
+        decimated until the figure compiles."""
+        import shutil
+        output = self._output
+        engine = stats["engine"]
+
+        if engine != "lualatex" and shutil.which("lualatex") is not None:
+            sys.stderr.write("Plotz: TeX capacity exceeded in %s.tex, retrying with lualatex\n"
+                             % output)
+            if compile_preview(output, stats, "lualatex", self._engine_options("lualatex")):
+                stats["fallback"] = "lualatex"
+                stats["fallback_engine"] = "lualatex"
+                sys.stderr.write("Plotz: %s.tex should be included in a document "
+                                 "compiled with lualatex\n" % output)
+                return
+
+        while stats["capacity_exceeded"] and self._decimate < 2**TikzGenerator.MAX_DECIMATION:
+            self._decimate *= 2
+            sys.stderr.write("Plotz: TeX capacity exceeded in %s.tex, "
+                             "retrying with lines decimated by a factor %d\n"
+                             % (output, self._decimate))
+            self.generate()
+            self._write()
+            stats["tex_bytes"] = os.path.getsize(output + ".tex")
+            if compile_preview(output, stats, engine, self._engine_options(engine)):
+                stats["fallback"] = "decimate:%d" % self._decimate
+                return
+
+        sys.stderr.write("Plotz: could not produce %s.pdf\n" % output)
+
+    def manifest(self):
+        """Dependency :py:class:`Manifest` of the generated output"""
+        return Manifest(self._output, self._plot.depends,
+                        self._plot._inputs) #pylint: disable=protected-access
+
+
+    def _define_styles(self):
+        self._define_style(self._style.color,
                            "/header/colors",
                            r"\definecolor{color%s}{HTML}{%s}")
 
-        self._define_style(self._plot.style.marker,
+        self._define_style(self._style.marker,
                            "/header/markers",
                            r"\def\marker%s{%s}")
 
-        self._define_style(self._plot.style.pattern,
+        self._define_style(self._style.pattern,
                            "/header/patterns",
                            r"\tikzstyle{pattern%s}=[%s]")
 
-        self._define_style(self._plot.style.thickness,
+        self._define_style(self._style.thickness,
                            "/header/thickness",
                            r"\tikzstyle{thick%s}=[%s]")
 
@@ -327,33 +1632,207 @@ class TikzGenerator(object):
                                % (options["style"], shift, options["marker"]))
 
     def _line(self, line):
+        #pylint: disable=protected-access
         options = self._line_options(line)
 
         self._line_legend(line, options)
 
-        self._latex.append("/lines", r"\draw[%s]" % options["style"])
+        if line.raster:
+            self._raster(line)
+            return
+
+        if line.envelope:
+            self._envelope(line, options)
+            return
+
+        mask = self._markers_mask(line)
+        self._line_points(line, options, mask, "/lines", self._decimate)
+
+        # Draft version: at most `draft_points` points per line
+        npoints = sum(len(subline) for subline in line.points)
+        self._line_points(line, options, mask, "/linesdraft", self._draft_decimation(npoints))
+
+    def _markers_mask(self, line):
+        """Markers of a line, as laid out in this output
+
+        The markers mask is computed once for the plot itself. Array-based
+        filters (which may depend on distances in the rendered plot, see
+        :py:meth:`plotz.utils.Markers.minDistance`) are run again for variants
+        of another size or scale."""
+        #pylint: disable=protected-access
+        plot = self._plot
+        mask = line._markers_mask
+        if (mask is not None and hasattr(line.markers_filter, "mask")
+                and (self._size_x*self._scale, self._size_y*self._scale)
+                != (plot.size_x*plot.scale, plot.size_y*plot.scale)):
+            mask = line._scaled_mask(
+                self._size_x*self._scale / (plot.x.max-plot.x.min),
+                self._size_y*self._scale / (plot.y.max-plot.y.min))
+        return mask
+
+    def _line_points(self, line, options, mask, path, decimate):
+        self._latex.append(path, r"\draw[%s]" % options["style"])
+        for i, subline in enumerate(line.points):
+            markers = [options["marker"]] * len(subline)
+            if mask is not None:
+                markers = [options["marker"] if m else "" for m in mask[i]]
+
+            points = zip(subline, markers)
+            if decimate > 1:
+                points = _decimate(list(points), decimate)
+
+            draw = "  "
+            for ((x, y), marker) in points:
+                self._latex.append(path,
+                                   "%s(%.15f,%.15f)%s" % (draw, x, y, marker))
+                draw = options["draw"]
+
+            self._latex.append(path, ";")
+
+    def _envelope(self, line, options):
+        """Downsampled line (see :py:attr:`plotz.Line.envelope`)"""
+        plot = self._plot
+
+        # One column per pt of the plotting area; the draft version gets
+        # `draft_points` points at most
+        columns = max(1, int(math.ceil(self._size_x*self._scale)))
+        draft = max(1, min(columns, plot.draft_points // 4))
+
+        for (path, ncols) in (("/lines", columns), ("/linesdraft", draft)):
+            for subline in line.points:
+                runs = _m4(subline, plot.x.min, plot.x.max, ncols)
+                if line.envelope == "fill":
+                    # Upper bound, then lower bound backwards
+                    points = ([subline[run[2]] for run in runs] +
+                              [subline[run[1]] for run in reversed(runs)])
+                    command = r"\filldraw[%s]" % options["style"]
+                    end = "--cycle;"
+                else:
+                    points = [subline[i] for i in sorted(set(i for run in runs for i in run))]
+                    command = r"\draw[%s]" % options["style"]
+                    end = ";"
+
+                self._latex.append(path, command)
+                draw = "  "
+                for (x, y) in points:
+                    self._latex.append(path, "%s(%.15f,%.15f)" % (draw, x, y))
+                    draw = "--"
+                self._latex.append(path, end)
+
+    def _append_lines(self, contents):
+        """Append contents to both the full and draft versions of lines"""
+        self._latex.append("/lines", contents)
+        self._latex.append("/linesdraft", contents)
+
+    def _raster(self, line):
+        plot = self._plot
+        (width, height) = (self._size_x*self._scale, self._size_y*self._scale)
+
+        pixels_per_pt = line.raster_dpi / 72.27
+        raster = Raster(int(math.ceil(width * pixels_per_pt)),
+                        int(math.ceil(height * pixels_per_pt)),
+                        (plot.x.min, plot.x.max), (plot.y.min, plot.y.max),
+                        brush=max(1, int(round(pixels_per_pt))))
+
         for subline in line.points:
+            if line.line:
+                raster.polyline(subline)
+            else:
+                raster.points(subline)
 
-            points = iter(subline)
-            (x, y) = next(points)
+        name = "raster%s" % self._index(next(self._rasters))
+        filename = "%s-%s.png" % (self._output, name)
+        raster.write(filename, self._style.color[line.color])
+        self._files.append(filename)
 
-            marker = options["marker"]
-            if line.markers_filter.send((x, y)) is False:
-                marker = ""
+        self._image(name, (plot.x.min, plot.x.max), (plot.y.min, plot.y.max))
 
-            self._latex.append("/lines",
-                               "  (%.15f,%.15f)%s" % (x, y, marker))
+    def _image(self, name, x_range, y_range, options=""):
+        """Embed a PNG image written next to the figure file.
 
-            for (x, y) in points:
-                marker = options["marker"]
-                if line.markers_filter.send((x, y)) is False:
-                    marker = ""
-                self._latex.append("/lines",
-                                   "%s(%.15f,%.15f)%s" % (options["draw"], x, y,
-                                                          marker))
+        Args:
+          name (str): suffix of the image file name (without extension)
+          x_range (tuple): (min, max) data coordinates covered horizontally
+          y_range (tuple): (min, max) data coordinates covered vertically
+          options (str): extra \\includegraphics options, with a leading comma
+        """
+        ((x0, x1), (y0, y1)) = (x_range, y_range)
+
+        # The image is looked for next to the figure file
+        self._append_lines([
+            r"\pgfmathsetlengthmacro\plotz@rasterwidth{%.15f*\plotz@scalex*\plotz@X}"
+            % (x1-x0),
+            r"\pgfmathsetlengthmacro\plotz@rasterheight{%.15f*\plotz@scaley*\plotz@Y}"
+            % (y1-y0),
+            r"\node[anchor=south west,inner sep=0]at(%.15f,%.15f){" % (x0, y0),
+            r"  \includegraphics[width=\plotz@rasterwidth,height=\plotz@rasterheight%s]"
+            r"{\plotz@file-%s.png}};" % (options, name),
+        ])
+
+    def _density_colors(self, density):
+        levels = density.levels
+        return [_interpolate(self._style.density, float(level) / max(levels-1, 1))
+                for level in range(levels)]
+
+    def _density(self, density):
+        colors = self._density_colors(density)
+        levels = density.levels
+        name = "density%s" % self._index(next(self._densities))
+
+        self._latex.append("/header/colors", [
+            r"\definecolor{%s%s}{HTML}{%s}" % (name, self._index(level), color)
+            for (level, color) in enumerate(colors)
+        ])
+
+        self._bar_legend(density, "fill=%s%s" % (name, self._index(levels-1)))
+
+        if density.range is None:
+            return
 
-            self._latex.append("/lines", ";")
+        (nx, ny) = density.bins
+        ((x0, x1), (y0, y1)) = density.range
+        (dx, dy) = ((x1-x0) / nx, (y1-y0) / ny)
 
+        # Map counts to color levels (0 for empty cells)
+        cmax = max(density.counts)
+        if cmax == 0:
+            return
+        cell_levels = [int(math.ceil(levels * float(c) / cmax)) for c in density.counts]
+
+        if density.raster:
+            rgba = bytearray(4 * nx * ny)
+            rgb = [bytearray.fromhex(c) for c in colors]
+            for j in range(ny):
+                for i in range(nx):
+                    level = cell_levels[j*nx + i]
+                    if level > 0:
+                        pixel = 4 * ((ny-1-j)*nx + i)
+                        rgba[pixel:pixel+3] = rgb[level-1]
+                        rgba[pixel+3] = 255
+
+            filename = "%s-%s.png" % (self._output, name)
+            _write_png(filename, nx, ny, rgba)
+            self._files.append(filename)
+
+            self._image(name, (x0, x1), (y0, y1), ",interpolate=false")
+            return
+
+        # Adjacent cells of the same color in a row are drawn as one rectangle
+        for j in range(ny):
+            row = cell_levels[j*nx:(j+1)*nx]
+            i = 0
+            while i < nx:
+                level = row[i]
+                end = i + 1
+                while end < nx and row[end] == level:
+                    end += 1
+
+                if level > 0:
+                    self._append_lines("".join([
+                        r"\fill[%s%s]" % (name, self._index(level-1)),
+                        "(%.15f,%.15f)" % (x0 + i*dx, y0 + j*dy),
+                        "rectangle(%.15f,%.15f);" % (x0 + end*dx, y0 + (j+1)*dy)]))
+                i = end
 
     def _bar_legend(self, bar, style):
         #pylint: disable=blacklisted-name
@@ -381,14 +1860,71 @@ class TikzGenerator(object):
             x0 = bins[i] + dx * (index + 0.5 * histogram.gap)
             x1 = x0 + dx
 
-            self._latex.append("/lines", "".join([
+            self._append_lines("".join([
                 r"\draw[%s]" % style,
                 "(%.15f,%.15f)" % (x0, plot.y.min),
                 "rectangle(%.15f,%.15f);" % (x1, y)]))
 
-    def _axis(self, axis):
+    def _draft_decimation(self, npoints):
+        """Decimation factor of the draft version of a data series"""
+        return max(int(math.ceil(float(npoints) / max(self._plot.draft_points, 1))),
+                   self._decimate)
+
+    def _band(self, band):
+        style = "color%s,fill opacity=%f" % (self._index(band.color), band.opacity)
+        self._bar_legend(band, "fill=" + style)
+
+        # Lower bound, then upper bound backwards, as a single closed path
+        for (path, decimate) in (("/lines", self._decimate),
+                                 ("/linesdraft", self._draft_decimation(len(band.points)))):
+            points = _decimate(band.points, decimate)
+            self._latex.append(path, r"\fill[%s]" % style)
+            self._latex.append(path, [
+                "%s(%.15f,%.15f)" % ("--" if i else "  ", x, lo)
+                for (i, (x, lo, _)) in enumerate(points)])
+            self._latex.append(path, [
+                "--(%.15f,%.15f)" % (x, hi)
+                for (x, _, hi) in reversed(points)])
+            self._latex.append(path, "--cycle;")
+
+    def _errorbar(self, bars):
+        style = "color%s" % self._index(bars.color)
+
+        marker = ""
+        if bars.markers is not None:
+            marker = r"node{\marker%s}" % self._index(bars.markers)
+
+        if bars.title:
+            shift = -1.5 * next(self._legend_shift)
+            self._latex.append("/legend", "".join([
+                r"\draw[%s](1em,%fem)++(0,-0.5em)--++(0,1em)" % (style, shift),
+                r"(1em,%fem)%s++(1em,0)" % (shift, marker),
+                r"node[right,inner sep=2pt,black]{%s};" % bars.title,
+            ]))
+
+        cap = ""
+        if bars.cap:
+            cap = "++(-%fem,0)--++(%fem,0)" % (bars.cap, 2*bars.cap)
+
+        # All error bars are drawn as a single path
+        for (path, decimate) in (("/lines", self._decimate),
+                                 ("/linesdraft", self._draft_decimation(len(bars.points)))):
+            points = _decimate(bars.points, decimate)
+            self._latex.append(path, r"\draw[%s]" % style)
+            self._latex.append(path, [
+                "(%.15f,%.15f)--(%.15f,%.15f)%s(%.15f,%.15f)%s(%.15f,%.15f)%s"
+                % (x, lo, x, hi, cap, x, lo, cap, x, y, marker)
+                for (x, y, lo, hi) in points])
+            self._latex.append(path, ";")
+
+    def _axis(self, axis, labels=True):
         #pylint: disable=protected-access
 
+        # By default, the axis is drawn at the minimum of the other axis
+        pos = axis.pos
+        if pos is None:
+            pos = (self._plot.y if axis is self._plot.x else self._plot.x).min
+
         # Options
         tick_options = "rotate=%f,anchor=%s" % (axis.tick_rotate, axis.tick_anchor)
 
@@ -415,22 +1951,27 @@ class TikzGenerator(object):
         # Axis
         self._latex.append("/foreground/axes",
                            r"\draw(%s)--(%s);"
-                           % (_coord(axis.min, axis.pos), _coord(axis.max, axis.pos)))
+                           % (_coord(axis.min, pos), _coord(axis.max, pos)))
 
         # Label
-        if axis.label is not None:
+        if axis.label is not None and labels:
             self._latex.append("/foreground/axes",
                                r"\draw(%s)++(%s)"
-                               % (_coord(0.5*(axis.min+axis.max), axis.pos),
+                               % (_coord(0.5*(axis.min+axis.max), pos),
                                   _coord(0, "-%fem"%axis.label_shift)) +
                                r"node[%s]{%s};" % (label_options, axis.label))
 
         # Ticks
         for (x, label) in axis.ticks:
+            tick = r"\draw(%s)++(%s)--++(%s)" % (_coord(x, pos),
+                                                 _coord(0, "0.5em"),
+                                                 _coord(0, "-1em"))
+            if not labels:
+                self._latex.append("/foreground/axes", tick + ";")
+                continue
+
             self._latex.append("/foreground/axes", [
-                r"\draw(%s)++(%s)--++(%s)" % (_coord(x, axis.pos),
-                                              _coord(0, "0.5em"),
-                                              _coord(0, "-1em")),
+                tick,
                 r"   node[%s]{%s};" % (tick_options, label)])
 
     def _grid(self):
@@ -482,7 +2023,7 @@ class TikzGenerator(object):
                                % self._plot.title)
 
 
-    def _size(self):
+    def _bbox(self):
         plot = self._plot
 
         self._latex.append("/background/bbox",
@@ -491,51 +2032,159 @@ class TikzGenerator(object):
                                plot.x.max, plot.y.max
                            ))
 
+    def _size(self):
+        plot = self._plot
+
         self._latex.append("/scale", r"\def\plotz@scalex{%f}"
-                           % (plot.size_x*plot.scale / (plot.x.max-plot.x.min)))
+                           % (self._size_x*self._scale / (plot.x.max-plot.x.min)))
         self._latex.append("/scale", r"\def\plotz@scaley{%f}"
-                           % (plot.size_y*plot.scale / (plot.y.max-plot.y.min)))
-
-    def _compile(self):
-        with TmpDir() as tmp:
-            with open(os.path.join(tmp, "standalone.tex"), "w") as f:
-                f.write("%\n".join([
-                    r"\errorstopmode",
-                    r"\documentclass{standalone}",
-                    r"\usepackage{plotz}",
-                    r"\begin{document}",
-                    r"\plotz{plotz}",
-                    r"\end{document}",
-                ]))
-
-            with open(os.path.join(tmp, "plotz.tex"), "w") as f:
-                self._latex.write(f)
-
-            subprocess.call(["cp",
-                             os.path.join(tmp, "plotz.tex"),
-                             self._plot.output+".tex"])
-
-            pdflatex = subprocess.Popen(["pdflatex", "-file-line-error", "standalone.tex"],
-                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                        stdin=subprocess.PIPE, cwd=tmp)
-            pdflatex.stdin.close()
-
-            context = 0
-            error = re.compile(r"^.+:\d+: ")
-            for line in pdflatex.stdout:
-                line = line.decode()
-                if error.match(line):
-                    context = max(context, 3)
-                if context > 0:
-                    sys.stderr.write(line)
-                    context -= 1
-
-            if os.path.exists(os.path.join(tmp, "standalone.pdf")):
-                subprocess.call(["cp",
-                                 os.path.join(tmp, "standalone.pdf"),
-                                 self._plot.output+".pdf"])
-
+                           % (self._size_y*self._scale / (plot.y.max-plot.y.min)))
+        self._latex.append("/scale", r"\def\plotz@sizex{%f}" % (self._size_x*self._scale))
+        self._latex.append("/scale", r"\def\plotz@sizey{%f}" % (self._size_y*self._scale))
+
+    def _write(self):
+        """Write the TikZ code to its final location
+
+        The file is atomically replaced, so that a figure is never left
+        half-written."""
+        import hashlib
+        import threading
+        filename = self._output + ".tex"
+        tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+        contents = hashlib.md5()
+        with open(tmp, "w") as f:
+            self._latex.write(_HashedStream(f, contents))
+
+            # Stamp identifying the figure contents, used to name externalized
+            # versions of the figure
+            md5 = hashlib.md5(contents.hexdigest().encode())
+            md5.update(str(Manifest.sty_version()).encode())
+            f.write("%\n".join([
+                r"\makeatletter",
+                r"\def\plotz@stamp{%s}" % md5.hexdigest()[:8],
+                r"\makeatother",
+            ]) + "%\n")
+
+        os.replace(tmp, filename)
 
     @staticmethod
     def _index(index):
         return chr(ord('A')+index)
+
+
+class GridGenerator(TikzGenerator):
+    """ Renderer of a :py:class:`plotz.Grid` of panels
+
+    All panels are drawn in a single TikZ picture, so that the whole grid gets
+    compiled (and sized by ``\\plotz``) only once. Each panel is drawn in its
+    own scope, shifted to its place in the grid and scaled according to the
+    ranges of its axes.
+
+    Args:
+      grid: the :py:class:`plotz.Grid` to render
+      variant: optional :py:class:`plotz.Variant`, overriding some settings of
+               the grid
+    """
+    #pylint: disable=too-few-public-methods
+
+    #: Insertion points where the contents of panels are appended
+    PANEL_KEYS = ["/background/bbox", "/background/grid", "/lines", "/linesdraft",
+                  "/foreground/axes", "/foreground/user", "/foreground"]
+
+    def _generate(self):
+        grid = self._plot
+        panels = grid.panels()
+        cells = set(index for (index, _) in panels)
+
+        self._skeleton()
+        self._define_styles()
+        self._size()
+
+        (width, height) = (self._size_x*self._scale, self._size_y*self._scale)
+        for ((i, j), panel) in panels:
+            start = [self._latex.size(key) for key in GridGenerator.PANEL_KEYS]
+
+            # With shared axes, only outer panels get tick labels
+            labels_x = not grid.share_x or not any((k, j) in cells
+                                                   for k in range(i+1, grid.rows))
+            labels_y = not grid.share_y or not any((i, k) in cells for k in range(j))
+
+            gen = self._panel_generator(panel)
+            gen._contents((labels_x, labels_y)) #pylint: disable=protected-access
+            if panel.tikz:
+                self._latex.append("/foreground/user", panel.tikz)
+            self._panel_title(panel)
+
+            # Panel coordinates: the lower left corner of the plotting area is
+            # placed at its position in the grid (rows are counted from the top)
+            row = grid.rows - 1 - i
+            scale_x = width / (panel.x.max-panel.x.min)
+            scale_y = height / (panel.y.max-panel.y.min)
+            scope = "".join([
+                r"\begin{scope}[shift={(%f,%f)},xshift=%fem,yshift=%fem,"
+                % (j*width - panel.x.min*scale_x, row*height - panel.y.min*scale_y,
+                   j*grid.gap_x, row*grid.gap_y),
+                r"x=%f*\plotz@X,y=%f*\plotz@Y]" % (scale_x, scale_y),
+                r"\def\plotz@scalex{%f}\def\plotz@scaley{%f}" % (scale_x, scale_y),
+            ])
+            for (key, size) in zip(GridGenerator.PANEL_KEYS, start):
+                self._latex.wrap(key, size, scope, r"\end{scope}")
+
+        self._title()
+        self._legend()
+
+        self._latex.append("/foreground/user", grid.tikz)
+
+    def _emitted_points(self):
+        return sum(self._line_coordinates(panel) for (_, panel) in self._plot.panels())
+
+    def _panel_generator(self, panel):
+        """Generator appending the contents of a panel to the grid output"""
+        #pylint: disable=protected-access
+        gen = TikzGenerator(panel)
+        gen._output = self._output
+        gen._style = self._style
+        gen._scale = self._scale
+        gen._size_x = self._size_x
+        gen._size_y = self._size_y
+        gen._decimate = self._decimate
+
+        gen._latex = self._latex
+        gen._legend_shift = self._legend_shift
+        gen._rasters = self._rasters
+        gen._densities = self._densities
+        gen._files = self._files
+        return gen
+
+    def _panel_title(self, panel):
+        if panel.title is not None:
+            self._latex.append("/foreground",
+                               r"\draw(%f,%f)++(0,1em)node[anchor=south]{%s};"
+                               % (0.5*(panel.x.min+panel.x.max), panel.y.max, panel.title))
+
+    def _title(self):
+        # The grid title is placed above everything else, including panel titles
+        if self._plot.title is not None:
+            self._latex.append("/foreground",
+                               r"\draw(current bounding box.north)++(0,1em)"
+                               r"node[anchor=south]{%s};" % self._plot.title)
+
+    def _size(self):
+        grid = self._plot
+
+        # Figure coordinates are expressed in pt; gaps between panels (in em)
+        # are not affected by the scaling of the figure
+        (width, height) = (self._size_x*self._scale, self._size_y*self._scale)
+        self._latex.append("/scale", r"\def\plotz@scalex{1}")
+        self._latex.append("/scale", r"\def\plotz@scaley{1}")
+        self._latex.append("/scale", r"\def\plotz@sizex{%f}" % (grid.cols*width))
+        self._latex.append("/scale", r"\def\plotz@sizey{%f}" % (grid.rows*height))
+
+    def manifest(self):
+        #pylint: disable=protected-access
+        depends = list(self._plot.depends)
+        inputs = list(self._plot._inputs)
+        for (_, panel) in self._plot.panels():
+            depends += panel.depends
+            inputs += panel._inputs
+        return Manifest(self._output, depends, inputs)
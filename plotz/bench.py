@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of PlotZ, a plotting library
+#
+# Copyright (C) 2017
+#   F. Févotte     <fevotte@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+# The GNU General Public License is contained in the file COPYING.
+
+""" Benchmarks of PlotZ hot paths
+
+Usage: python -m plotz.bench [options]
+
+Each benchmark is run for several problem sizes (number of data points), and
+results are reported in JSON format.
+
+The time needed to import PlotZ is also measured (using ``python -X
+importtime``), and modules which should only be loaded when figures are
+compiled are checked not to be imported by ``import plotz``.
+"""
+#pylint: disable=invalid-name,protected-access
+
+import sys
+import os
+import io
+import math
+import time
+import json
+import platform
+import argparse
+import shutil
+import subprocess
+import plotz
+from plotz import Plot, Function, DataFile
+from plotz.backend import TikzGenerator, TmpDir
+from plotz.utils import Markers
+
+BENCHMARKS = []
+
+#: Modules which PlotZ only imports when they are needed
+LAZY_MODULES = ["asyncio", "difflib", "glob", "hashlib", "inspect", "json", "re",
+                "shutil", "struct", "subprocess", "tempfile", "threading", "zlib"]
+
+def benchmark(name):
+    """Register a benchmark
+
+    The decorated function takes a problem size *n* and a temporary directory,
+    performs any necessary setup, and returns the function to be timed.
+    """
+    def decorator(fun):
+        BENCHMARKS.append((name, fun))
+        return fun
+    return decorator
+
+def _points(n):
+    return [(i, math.sin(0.01*i)) for i in range(n)]
+
+def _plot(n, output, markers=False):
+    """Plot ready to be rendered, without pdf preview"""
+    p = Plot(output)
+    p.preview = False
+    line = p.plot(_points(n))
+    if markers:
+        line.style({"markers": True, "markers_filter": Markers.oneInN(10)})
+
+    p.legend._update()
+    p.x._update()
+    p.y._update()
+    p.x.pos = p.y.min
+    p.y.pos = p.x.min
+    p._update_markers()
+    return p
+
+
+@benchmark("DataFile")
+def _bench_datafile(n, tmp):
+    filename = os.path.join(tmp, "data.dat")
+    with open(filename, "w") as f:
+        for (x, y) in _points(n):
+            f.write("%.15f %.15f\n" % (x, y))
+
+    def run():
+        for _ in DataFile(filename):
+            pass
+    return run
+
+@benchmark("Function")
+def _bench_function(n, _):
+    def run():
+        for _ in Function(math.sin, samples=n, range=(0, 1)):
+            pass
+    return run
+
+@benchmark("Plot.plot")
+def _bench_plot(n, tmp):
+    data = _points(n)
+    def run():
+        Plot(os.path.join(tmp, "plot")).plot(data)
+    return run
+
+@benchmark("Axis._update_ticks")
+def _bench_ticks(n, tmp):
+    p = Plot(os.path.join(tmp, "plot"))
+    p.plot(_points(n))
+    def run():
+        p.x.ticks = None
+        p.x._update_ticks()
+    return run
+
+@benchmark("TikzGenerator._line")
+def _bench_line(n, tmp):
+    p = _plot(n, os.path.join(tmp, "plot"))
+    gen = TikzGenerator(p)
+    gen.generate()
+    def run():
+        gen._line(p.data_series[0])
+    return run
+
+@benchmark("TikzGenerator._line+markers")
+def _bench_line_markers(n, tmp):
+    p = _plot(n, os.path.join(tmp, "plot"), markers=True)
+    gen = TikzGenerator(p)
+    gen.generate()
+    def run():
+        gen._line(p.data_series[0])
+    return run
+
+@benchmark("TikzGenerator._line+envelope")
+def _bench_line_envelope(n, tmp):
+    p = _plot(n, os.path.join(tmp, "plot"))
+    p.data_series[0].envelope = "line"
+    gen = TikzGenerator(p)
+    gen.generate()
+    def run():
+        gen._line(p.data_series[0])
+    return run
+
+@benchmark("LatexOutput.write")
+def _bench_write(n, tmp):
+    p = _plot(n, os.path.join(tmp, "plot"))
+    gen = TikzGenerator(p)
+    gen.generate()
+    def run():
+        gen._latex.write(io.StringIO())
+    return run
+
+@benchmark("compile")
+def _bench_compile(n, tmp):
+    if shutil.which("pdflatex") is None:
+        return None
+
+    data = _points(n)
+    def run():
+        with Plot(os.path.join(tmp, "plot")) as p:
+            p.preview = True
+            p.plot(data)
+    return run
+
+
+def run_benchmarks(sizes, repeat=3, select=None, stream=sys.stderr):
+    """Run benchmarks
+
+    Args:
+      sizes: list of problem sizes
+      int repeat: number of runs of each benchmark; the best time is kept
+      select: if given, list of names of the benchmarks to run
+      stream: stream where progress is reported
+
+    Returns:
+      a list of results, each of which is a dictionary
+    """
+    results = []
+    with TmpDir() as tmp:
+        for (name, fun) in BENCHMARKS:
+            if select and name not in select:
+                continue
+
+            for n in sizes:
+                run = fun(n, tmp)
+                if run is None:
+                    stream.write("%-30s %10d  skipped\n" % (name, n))
+                    continue
+
+                times = []
+                for _ in range(repeat):
+                    start = time.time()
+                    run()
+                    times.append(time.time() - start)
+
+                results.append({"name": name, "size": n,
+                                "time": min(times), "times": times})
+                stream.write("%-30s %10d  %10.4fs\n" % (name, n, min(times)))
+                stream.flush()
+    return results
+
+def import_time(repeat=3, stream=sys.stderr):
+    """Measure the time needed to import PlotZ in a fresh interpreter
+
+    Args:
+      int repeat: number of measurements; the best time is kept
+      stream: stream where progress is reported
+
+    Returns:
+      a dictionary with the "time" (in seconds) and "times" of the import, and
+      the list of "lazy_modules" (see :py:data:`LAZY_MODULES`) which it loaded
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = (os.path.dirname(os.path.dirname(os.path.abspath(plotz.__file__)))
+                         + os.pathsep + env.get("PYTHONPATH", ""))
+    code = "import sys, plotz; print(' '.join(sorted(sys.modules)))"
+
+    times = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                              env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, check=True)
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "plotz":
+                times.append(int(fields[1]) * 1e-6)
+        modules = proc.stdout.split()
+
+    loaded = [m for m in LAZY_MODULES if m in modules]
+    stream.write("%-30s %10s  %10.4fs\n" % ("import plotz", "", min(times)))
+    if loaded:
+        stream.write("  warning: modules loaded at import: %s\n" % ", ".join(loaded))
+    stream.flush()
+    return {"time": min(times), "times": times, "lazy_modules": loaded}
+
+def main(argv=None):
+    """Entry point of the benchmark suite"""
+    parser = argparse.ArgumentParser(prog="python -m plotz.bench",
+                                     description="PlotZ benchmarks")
+    parser.add_argument("-s", "--sizes", default="10000,100000",
+                        help="comma-separated problem sizes (default: %(default)s)")
+    parser.add_argument("--full", action="store_true",
+                        help="run all problem sizes from 10^4 to 10^7")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of runs of each benchmark (default: %(default)s)")
+    parser.add_argument("-b", "--benchmark", action="append",
+                        choices=[name for (name, _) in BENCHMARKS],
+                        help="benchmark to run (default: all)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="JSON output file (default: standard output)")
+    parser.add_argument("--max-import-time", type=float, default=None,
+                        help="fail if importing PlotZ takes longer (in ms)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(float(s)) for s in args.sizes.split(",")]
+    if args.full:
+        sizes = [10**i for i in range(4, 8)]
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "import": import_time(args.repeat),
+        "results": run_benchmarks(sizes, args.repeat, args.benchmark),
+    }
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    # Import time regressions
+    imported = results["import"]
+    if imported["lazy_modules"]:
+        return 1
+    if args.max_import_time is not None and imported["time"]*1e3 > args.max_import_time:
+        sys.stderr.write("import plotz: %.1fms > %.1fms\n"
+                         % (imported["time"]*1e3, args.max_import_time))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of PlotZ, a plotting library
+#
+# Copyright (C) 2017
+#   F. Févotte     <fevotte@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+# The GNU General Public License is contained in the file COPYING.
+
+""" Batch generation of PlotZ figures """
+#pylint: disable=invalid-name
+
+import sys
+import os
+import fnmatch
+import glob
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from plotz.backend import Manifest, compile_preview, compile_external, update_externals, make_svg
+
+def discover(paths, pattern="plot.py"):
+    """Find figure scripts
+
+    Args:
+      paths: list of script files or directories. Directories are recursively
+             searched for scripts.
+      str pattern: shell-style pattern matching script names
+
+    Returns:
+      the sorted list of found scripts
+    """
+    scripts = []
+    for path in paths:
+        if os.path.isfile(path):
+            scripts.append(path)
+            continue
+
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            scripts += [os.path.join(dirpath, f)
+                        for f in sorted(fnmatch.filter(filenames, pattern))]
+
+    return [os.path.normpath(s) for s in scripts]
+
+def up_to_date(script, preview=None, svg=None):
+    """Check whether all outputs of a script are up to date
+
+    Outputs of the script are identified by the dependency manifests (see
+    :py:class:`plotz.backend.Manifest`) found in the script directory.
+
+    Args:
+      str script: path to the figure script
+      preview: requested production mode of the pdf previews, or None
+      svg: requested production mode of the svg versions, or None
+    """
+    script = os.path.abspath(script)
+    manifests = [Manifest.load(f)
+                 for f in glob.glob(os.path.join(os.path.dirname(script), "*.deps.json"))]
+    manifests = [m for m in manifests if m is not None and m.get("script") == script]
+
+    return manifests != [] and all(Manifest.fresh(m, preview, svg) for m in manifests)
+
+
+class Job(object):
+    """Execution of a figure script
+
+    The script is run by a separate python interpreter, in the directory
+    containing it.
+
+    Args:
+      str script: path to the figure script
+    """
+    #pylint: disable=too-few-public-methods
+
+    def __init__(self, script):
+        #: Path to the script
+        self.script = script
+
+        #: Job status: "pending", "skipped", "ok", "failed" or "timeout"
+        self.status = "pending"
+
+        #: Wall time (in seconds)
+        self.time = 0.
+
+        #: Script output (stdout and stderr)
+        self.log = ""
+
+    def run(self, timeout=None, env=None):
+        """Run the script
+
+        Args:
+          float timeout: maximum run time (in seconds)
+          dict env: environment variables for the script
+        """
+        directory = os.path.dirname(os.path.abspath(self.script))
+        start = time.time()
+
+        kwargs = {}
+        if os.name == "posix":
+            # Run each job in its own session, so that the whole process group
+            # (including TeX processes) can be killed on timeout.
+            kwargs["start_new_session"] = True
+
+        proc = subprocess.Popen([sys.executable, os.path.basename(self.script)],
+                                cwd=directory, env=env,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                **kwargs)
+        try:
+            out, _ = proc.communicate(timeout=timeout)
+            self.status = "ok" if proc.returncode == 0 else "failed"
+        except subprocess.TimeoutExpired:
+            if os.name == "posix":
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+            out, _ = proc.communicate()
+            self.status = "timeout"
+
+        self.log = out.decode(errors="replace")
+        self.time = time.time() - start
+        return self
+
+
+def build(scripts, jobs=None, timeout=None, force=False, env=None, stream=sys.stdout):
+    """Run figure scripts in parallel
+
+    Args:
+      scripts: list of figure scripts
+      int jobs: maximum number of scripts run concurrently (defaults to the
+                number of CPUs)
+      float timeout: maximum run time of each script (in seconds)
+      bool force: if False, scripts whose outputs are up to date are skipped
+      dict env: additional environment variables for the scripts
+      stream: stream where progress is reported
+
+    Returns:
+      the list of :py:class:`Job` objects
+    """
+    #pylint: disable=too-many-arguments
+
+    environ = dict(os.environ)
+    environ.update(env or {})
+
+    # Scripts are also run again if they did not produce the requested outputs
+    (preview, svg) = Manifest.requested(environ)
+
+    todo = []
+    all_jobs = []
+    for script in scripts:
+        job = Job(script)
+        all_jobs.append(job)
+        if not force and up_to_date(script, preview, svg):
+            job.status = "skipped"
+            stream.write("  %-8s %s\n" % ("skipped", script))
+        else:
+            todo.append(job)
+
+    def _run(job):
+        job.run(timeout, environ)
+        stream.write("  %-8s %s (%.2fs)\n" % (job.status, job.script, job.time))
+        if job.status != "ok":
+            stream.write("".join("    | " + l + "\n" for l in job.log.splitlines()))
+        stream.flush()
+        return job
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        list(pool.map(_run, todo))
+
+    return all_jobs
+
+def summary(jobs, wall_time, stream=sys.stdout, slowest=5):
+    """Print a timing summary of a batch of jobs
+
+    Args:
+      jobs: list of :py:class:`Job` objects
+      float wall_time: total wall time of the batch
+      stream: output stream
+      int slowest: number of slowest jobs to list
+    """
+    count = {}
+    for job in jobs:
+        count[job.status] = count.get(job.status, 0) + 1
+
+    cpu_time = sum(job.time for job in jobs)
+    stream.write("\n%d scripts: %s\n" % (
+        len(jobs), ", ".join("%d %s" % (n, status) for (status, n) in sorted(count.items()))))
+    stream.write("wall time: %.2fs, cumulated script time: %.2fs\n" % (wall_time, cpu_time))
+
+    ran = sorted((job for job in jobs if job.status != "skipped"),
+                 key=lambda job: -job.time)
+    if ran:
+        stream.write("slowest scripts:\n")
+        for job in ran[:slowest]:
+            stream.write("  %8.2fs  %s\n" % (job.time, job.script))
+
+
+def pending_previews(paths):
+    """Find figures whose pdf preview has been deferred
+
+    Args:
+      paths: list of directories to search for dependency manifests
+
+    Returns:
+      the sorted list of manifest files with a pending preview
+    """
+    manifests = []
+    for path in paths:
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for filename in sorted(fnmatch.filter(filenames, "*.deps.json")):
+                filename = os.path.join(dirpath, filename)
+                manifest = Manifest.load(filename)
+                if manifest is not None and manifest.get("preview_pending"):
+                    manifests.append(filename)
+    return manifests
+
+def previews(manifests, jobs=None, stream=sys.stdout):
+    """Produce deferred pdf previews (and their svg versions) in parallel
+
+    Args:
+      manifests: list of manifest files (see :py:func:`pending_previews`)
+      int jobs: maximum number of concurrent compilations
+      stream: stream where progress is reported
+
+    Returns:
+      the number of failed previews
+    """
+    def _preview(filename):
+        manifest = Manifest.load(filename)
+        output = manifest["output"]
+        engine = manifest.get("engine", "pdflatex")
+
+        start = time.time()
+        success = compile_preview(output, engine=engine)
+        if success and manifest.get("svg"):
+            make_svg(output, manifest["svg"], engine)
+        stream.write("  %-8s %s (%.2fs)\n" % ("ok" if success else "failed",
+                                              os.path.relpath(output), time.time()-start))
+
+        if success:
+            manifest["preview"] = True
+            manifest["preview_pending"] = False
+            manifest["outputs"].append(output + ".pdf")
+            if manifest.get("svg") and os.path.exists(output + ".svg"):
+                manifest["outputs"].append(output + ".svg")
+            Manifest.save(filename, manifest)
+            update_externals(output, manifest.get("external", []), engine)
+        return success
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        return list(pool.map(_preview, manifests)).count(False)
+
+
+def external_requests(filename):
+    """Read the externalized figures requested by a LaTeX document
+
+    When the ``plotz`` package is loaded with the ``external`` option, figures
+    for which no up-to-date externalized pdf exists are listed in the
+    ``<jobname>.plotz`` file.
+
+    Args:
+      str filename: path to the ``<jobname>.plotz`` file
+
+    Returns:
+      a list of dictionaries with "output" (basename of the figure), "keys"
+      (``\\plotz`` options), "key" (hash of the options), "pdf" (externalized
+      pdf) and "preamble" (additional preamble of the standalone document)
+      items
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    requests = []
+    preamble = ""
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("preamble "):
+                preamble = line[len("preamble "):]
+            elif line.startswith("figure "):
+                (output, keys, pdf) = line[len("figure "):].split("|")
+                requests.append({
+                    "output":   os.path.join(directory, output),
+                    "keys":     keys,
+                    "key":      pdf.rsplit("-", 1)[-1],
+                    "pdf":      os.path.join(directory, pdf + ".pdf"),
+                    "preamble": preamble,
+                })
+    return requests
+
+def externals(filename, jobs=None, stream=sys.stdout):
+    """Compile externalized figures requested by a LaTeX document in parallel
+
+    Compiled figures are recorded in their dependency manifest, so that
+    subsequent runs of the figure scripts keep their externalized versions up
+    to date.
+
+    Args:
+      str filename: path to the ``<jobname>.plotz`` file
+      int jobs:     maximum number of concurrent compilations
+      stream:       stream where progress is reported
+
+    Returns:
+      a tuple (*number of requests*, *number of failures*)
+    """
+    requests = [r for r in external_requests(filename) if not os.path.exists(r["pdf"])]
+    lock = threading.Lock()
+
+    def _external(request):
+        output = request["output"]
+        manifest_file = output + ".deps.json"
+        manifest = Manifest.load(manifest_file)
+        engine = "pdflatex" if manifest is None else manifest.get("engine", "pdflatex")
+
+        start = time.time()
+        success = compile_external(output, request["keys"], request["key"],
+                                   request["preamble"], engine)
+        stream.write("  %-8s %s [%s] (%.2fs)\n" % ("ok" if success else "failed",
+                                                   os.path.relpath(output), request["keys"],
+                                                   time.time()-start))
+
+        if success and manifest is not None:
+            with lock:
+                manifest = Manifest.load(manifest_file)
+                entry = dict((k, request[k]) for k in ("keys", "key", "preamble"))
+                recorded = manifest.setdefault("external", [])
+                if entry not in recorded:
+                    recorded.append(entry)
+                Manifest.save(manifest_file, manifest)
+        return success
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+        return (len(requests), list(pool.map(_external, requests)).count(False))
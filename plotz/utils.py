@@ -22,8 +22,10 @@
 """ Utility functions for PlotZ """
 #pylint: disable=invalid-name
 
+import abc
+import bisect
 import itertools
-from plotz.backend import consumer
+import math
 
 def ppfloat(x, fmt="%f"):
     """Return a pretty string representing the given float.
@@ -52,18 +54,136 @@ def nth(iterable, n, default=None):
     "Returns the nth item or a default value"
     return next(itertools.islice(iterable, n, None), default)
 
+class MarkersFilter(abc.ABC):
+    """Base class for array-based marker filters
+
+    Array-based filters decide at once which points of a whole sub-line get a
+    marker, which is much cheaper than sending points one by one to a
+    co-routine. Derived classes should implement :py:meth:`mask`. The
+    co-routine protocol (``send``) is still supported, so that array-based
+    filters can be used wherever co-routine filters are expected.
+    """
+
+    @abc.abstractmethod
+    def mask(self, points):
+        """Compute which points of a sub-line get a marker
+
+        Successive calls are made for successive sub-lines of the same line.
+
+        Args:
+          points: list of (*x*, *y*) tuples
+
+        Returns:
+          a list of booleans, True for each point which should get a marker.
+        """
+
+    def setup(self, scale_x, scale_y):
+        """Geometry of the rendered plot
+
+        This method is called once, before any call to :py:meth:`mask`, when
+        the final axes ranges are known.
+
+        Args:
+          float scale_x: length (in pt) of one unit along the *x* axis
+          float scale_y: length (in pt) of one unit along the *y* axis
+        """
+
+    def send(self, point):
+        """Co-routine protocol: decide whether one point gets a marker"""
+        return self.mask([point])[0]
+
+class _Always(MarkersFilter):
+    def mask(self, points):
+        return [True] * len(points)
+
+class _OneInN(MarkersFilter):
+    def __init__(self, N, start):
+        self._N = N
+        self._next = start
+
+    def mask(self, points):
+        n = len(points)
+        mask = [False] * n
+        if self._next < n:
+            marked = range(self._next, n, self._N)
+            mask[self._next::self._N] = [True] * len(marked)
+            self._next = marked[-1] + self._N - n
+        else:
+            self._next -= n
+        return mask
+
+class _EquallySpaced(MarkersFilter):
+    def __init__(self, dX, start):
+        self._dX = dX
+        self._next = start
+
+    def mask(self, points):
+        xs = [x for (x, _) in points]
+        n = len(xs)
+        mask = [False] * n
+
+        if xs == sorted(xs):
+            # Sorted abscissas: jump from one marker to the next
+            i = bisect.bisect_left(xs, self._next)
+            while i < n:
+                mask[i] = True
+                self._next += self._dX
+                i = bisect.bisect_left(xs, self._next, i+1)
+        else:
+            for i, x in enumerate(xs):
+                if x >= self._next:
+                    mask[i] = True
+                    self._next += self._dX
+
+        return mask
+
+class _MinDistance(MarkersFilter):
+    def __init__(self, dist):
+        self._dist = dist
+        self._scale_x = 1.
+        self._scale_y = 1.
+        self._grid = {}
+
+    def setup(self, scale_x, scale_y):
+        self._scale_x = scale_x
+        self._scale_y = scale_y
+
+    def mask(self, points):
+        # Markers are stored in a grid of cells of size `dist`: a new marker
+        # only has to be checked against markers in the neighbouring cells.
+        dist = self._dist
+        dist2 = dist * dist
+        grid = self._grid
+        mask = []
+        for (x, y) in points:
+            x *= self._scale_x
+            y *= self._scale_y
+            i = int(math.floor(x / dist))
+            j = int(math.floor(y / dist))
+
+            draw = True
+            for cell in itertools.product((i-1, i, i+1), (j-1, j, j+1)):
+                for (xx, yy) in grid.get(cell, ()):
+                    if (x-xx)**2 + (y-yy)**2 < dist2:
+                        draw = False
+                        break
+                if not draw:
+                    break
+
+            if draw:
+                grid.setdefault((i, j), []).append((x, y))
+            mask.append(draw)
+        return mask
+
 class Markers(object):
     """Built-in marker filters"""
 
     @staticmethod
-    @consumer
     def always():
         """Marker filter that displays a marker for each data point"""
-        while True:
-            yield True
+        return _Always()
 
     @staticmethod
-    @consumer
     def oneInN(N, start=0):
         """Marker filter that displays a marker for one data point in *N*
 
@@ -71,18 +191,9 @@ class Markers(object):
           int N: period of the markers. One data points in *N* gets a marker.
           int start: index of the first data point to have a marker.
         """
-        yield
-        i = start
-        while True:
-            if i == 0:
-                i = N
-                yield True
-            else:
-                yield False
-            i -= 1
+        return _OneInN(N, start)
 
     @staticmethod
-    @consumer
     def equallySpaced(dX, start=0):
         """Marker filter that displays markers equally spaced (with respect to the *x* coordinate)
 
@@ -91,12 +202,21 @@ class Markers(object):
                     least *dX*.
           float start: abscissa of the first displayed marker.
         """
-        ret = None
-
-        while True:
-            x, _ = yield ret
-            if x >= start:
-                ret = True
-                start += dX
-            else:
-                ret = False
+        return _EquallySpaced(dX, start)
+
+    @staticmethod
+    def minDistance(dist=15):
+        """Marker filter that keeps markers apart from one another on the page
+
+        A marker is displayed only if it lies at least *dist* away from all
+        previously displayed markers of the same line, as measured in the
+        rendered plot. The number of markers is thus bounded by the plot area,
+        regardless of the number of data points.
+
+        Variants of the plot with another size or scale get their own markers,
+        spaced according to their own dimensions.
+
+        Args:
+          float dist: minimal distance between markers (in pt)
+        """
+        return _MinDistance(dist)